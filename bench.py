@@ -0,0 +1,200 @@
+import os
+from os import path
+import sys
+import json
+import argparse
+import subprocess
+import shutil
+import tempfile
+import random
+import zipfile
+import io
+import time
+
+# 批量评测的离线性能测试：生成合成的学生提交、桩评测仓库与桩评测脚本，
+# 在不同的--parallel下分别运行grade.py，汇总各次运行的run_report.json。
+
+SOURCE_FILES = ["sleep.c", "pingpong.c", "primes.c", "find.c", "xargs.c"]
+
+STUB_MAKEFILE = """# stub
+GDBPORT = $(shell expr `id -u` % 5000 + 25000)
+"""
+
+# 桩评测脚本模拟编译（读取全部源文件）与测试（输出指定行数），每个存在的源文件得20分。
+STUB_TEST_SCRIPT = """#!/bin/bash
+cat user/*.c Makefile > /dev/null
+sleep {build_time}
+echo "== build done"
+n=0
+for f in {files}; do
+    if [ -f user/$f ]; then n=$((n+20)); fi
+done
+for i in $(seq {output_lines}); do
+    echo "== Test line $i: qemu-system-riscv64 -machine virt -bios none -kernel kernel/kernel -m 128M -smp 3 -nographic"
+done
+sleep {test_time}
+echo "Score: $n/100"
+"""
+
+
+def make_source(rng, file_name, size):
+    lines = [f"// {file_name}", '#include "kernel/types.h"', '#include "user/user.h"']
+    i = 0
+    while sum(len(line) + 1 for line in lines) < size:
+        lines.append(f"int f{i}(int a) {{ int s = {rng.randrange(1000)}; for (int j = 0; j < a; j++) s += j * {rng.randrange(100)}; return s; }}")
+        i += 1
+    return ("\n".join(lines) + "\n").encode()
+
+
+def make_archive(sources, padding, nesting, rng):
+    # 提交内容放在lab文件夹中，并按nesting层数嵌套在zip压缩包内。
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as zf:
+        for file_name, content in sources.items():
+            zf.writestr(f"lab/user/{file_name}", content)
+        if padding:
+            zf.writestr("lab/padding.bin", rng.randbytes(padding), compress_type=zipfile.ZIP_STORED)
+    data = buffer.getvalue()
+    for depth in range(nesting):
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as zf:
+            zf.writestr(f"nested{depth}.zip", data)
+        data = buffer.getvalue()
+    return data
+
+
+def generate_submissions(folder, args):
+    rng = random.Random(args.seed)
+    os.makedirs(folder)
+    generated = []
+    for i in range(args.submissions):
+        if generated and rng.random() < args.duplicates:
+            # 与此前的某份提交内容完全相同，用于测试评测结果缓存。
+            sources = dict(rng.choice(generated))
+        else:
+            sources = {file_name: make_source(rng, file_name, args.file_size) for file_name in SOURCE_FILES}
+            if rng.random() < args.missing:
+                sources.pop(rng.choice(SOURCE_FILES))
+        generated.append(sources)
+        with open(path.join(folder, f"{200000 + i}_学生{i}_file.zip"), "wb") as af:
+            af.write(make_archive(sources, args.padding, args.nesting, rng))
+
+
+def create_stub_repo(repo_path, args):
+    os.makedirs(path.join(repo_path, "user"))
+    with open(path.join(repo_path, "Makefile"), "w") as mf:
+        mf.write(STUB_MAKEFILE)
+    with open(path.join(repo_path, "user", "ulib.c"), "w") as uf:
+        uf.write("int main() { return 0; }\n")
+    script_path = path.join(repo_path, "grade-stub")
+    with open(script_path, "w") as sf:
+        sf.write(STUB_TEST_SCRIPT.format(
+            build_time=args.build_time, test_time=args.test_time,
+            output_lines=args.output_lines, files=" ".join(SOURCE_FILES),
+        ))
+    os.chmod(script_path, 0o755)
+    git = ["git", "-c", "user.name=bench", "-c", "user.email=bench@localhost"]
+    subprocess.run(git + ["init", "-q", "-b", "bench"], cwd=repo_path, check=True)
+    subprocess.run(git + ["add", "-A"], cwd=repo_path, check=True)
+    subprocess.run(git + ["commit", "-q", "-m", "stub"], cwd=repo_path, check=True)
+
+
+def write_config(config_path, repo_path):
+    config = {
+        "new_file": {file_name: f"user/{file_name}" for file_name in SOURCE_FILES},
+        "alter_file": {},
+        "default_handler": {"operation": "ignore"},
+        "plagiarism_test": {},
+        "overrides": [{
+            "file_path": "Makefile",
+            "operation": {"type": "alteration", "original": "GDBPORT = $(shell expr `id -u` % 5000 + 25000)", "altered": "GDBPORT = $(shell expr {env_id} + 30000)"},
+        }],
+        "moss_userid": 0,
+        "test_script": "grade-stub",
+        "script_output": "exec_log",
+        "result_regex": "^Score: ([0-9]{1,3})/100$",
+        "build_done_regex": "^== build done$",
+        "repo": repo_path,
+        "branch": "bench",
+    }
+    with open(config_path, "w") as cf:
+        cf.write(json.dumps(config, ensure_ascii=False, indent=4))
+
+
+def run_grader(work_path, parallel, grade_args):
+    # 每次运行都重新评测全部提交；同一次运行中内容相同的提交仍只评测一次。
+    output_dir = path.join(work_path, f"result_p{parallel}")
+    command = [sys.executable, path.join(work_path, "grade.py"), path.join(work_path, "bench.json"),
+               "-f", path.join(work_path, "student_files"), "-o", output_dir, "-p", str(parallel), "--regrade"] + grade_args
+    start_time = time.monotonic()
+    subprocess.run(command, cwd=work_path, check=True, stdout=subprocess.DEVNULL)
+    elapsed = time.monotonic() - start_time
+    with open(path.join(output_dir, "run_report.json"), "r", encoding="utf-8") as rf:
+        report = json.loads(rf.read())
+    report["process_time"] = round(elapsed, 3)
+    return report
+
+
+def print_report(reports):
+    phases = []
+    for report in reports.values():
+        phases += [phase for phase in report["phases"] if phase not in phases]
+    print(f"{'并行数':>6} {'提交数':>6} {'用时(s)':>9} {'总用时(s)':>9} {'份/分钟':>9} {'利用率':>7}  " + "  ".join(f"{phase + ' p50/p95':>22}" for phase in phases))
+    for parallel, report in reports.items():
+        phase_cols = []
+        for phase in phases:
+            stats = report["phases"].get(phase)
+            phase_cols.append(f"{stats['p50']:>10.3f}/{stats['p95']:<11.3f}" if stats else f"{'-':>22}")
+        print(f"{parallel:>9} {report['submissions']:>9} {report['wall_time']:>11.2f} {report['process_time']:>11.2f} "
+              f"{report['throughput_per_minute']:>12.1f} {report['mean_utilization']:>10.0%}  " + "  ".join(phase_cols))
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="批量评测的离线性能测试。")
+    arg_parser.add_argument("--submissions", "-n", type=int, default=50, help="生成的提交数量。默认为50。")
+    arg_parser.add_argument("--parallel", "-p", type=str, default="1,2,4,8", help="需要测试的并行任务数量，以逗号分隔。默认为1,2,4,8。")
+    arg_parser.add_argument("--file-size", type=int, default=4096, help="每个源文件的大致字节数。默认为4096。")
+    arg_parser.add_argument("--padding", type=int, default=0, help="每份提交中额外加入的无关文件的字节数，用于模拟较大的压缩包。默认为0。")
+    arg_parser.add_argument("--nesting", type=int, default=0, help="提交内容嵌套在zip压缩包中的层数。默认为0。")
+    arg_parser.add_argument("--duplicates", type=float, default=0.0, help="与此前某份提交内容相同的提交所占比例。默认为0。")
+    arg_parser.add_argument("--missing", type=float, default=0.0, help="缺少一个源文件的提交所占比例。默认为0。")
+    arg_parser.add_argument("--build-time", type=float, default=0.2, help="桩评测脚本模拟编译的时间（秒）。默认为0.2。")
+    arg_parser.add_argument("--test-time", type=float, default=0.5, help="桩评测脚本模拟测试的时间（秒）。默认为0.5。")
+    arg_parser.add_argument("--output-lines", type=int, default=200, help="桩评测脚本输出的行数。默认为200。")
+    arg_parser.add_argument("--seed", type=int, default=0, help="生成提交时使用的随机种子。默认为0。")
+    arg_parser.add_argument("--work-dir", type=str, default=None, help="性能测试的工作文件夹。默认在临时文件夹中创建，测试结束后删除。")
+    arg_parser.add_argument("--keep", action="store_true", default=False, help="测试结束后保留工作文件夹。")
+    arg_parser.add_argument("--report", type=str, default=None, help="将各次运行的run_report.json汇总保存至指定文件。")
+    arg_parser.add_argument("grade_args", nargs=argparse.REMAINDER, help="在--之后传递给grade.py的其他参数，例如-- --workspace-mode reset --build-cache。")
+    args = arg_parser.parse_args()
+
+    grade_args = args.grade_args[1:] if args.grade_args[:1] == ["--"] else args.grade_args
+    work_path = path.realpath(args.work_dir) if args.work_dir else tempfile.mkdtemp(prefix="autograde_bench_")
+    os.makedirs(work_path, exist_ok=True)
+    try:
+        # grade.py的各个缓存文件夹位于其所在目录，复制到工作文件夹中运行，以免影响正式评测。
+        real_path = path.dirname(path.realpath(__file__))
+        for file_name in ["grade.py", "plagiarism.py", "distributed.py"]:
+            shutil.copy(path.join(real_path, file_name), work_path)
+        repo_path = path.join(work_path, "stub_repo")
+        shutil.rmtree(repo_path, ignore_errors=True)
+        create_stub_repo(repo_path, args)
+        write_config(path.join(work_path, "bench.json"), repo_path)
+        stu_path = path.join(work_path, "student_files")
+        shutil.rmtree(stu_path, ignore_errors=True)
+        generate_submissions(stu_path, args)
+        print(f"已在{work_path}中生成{args.submissions}份提交。")
+
+        reports = {}
+        for parallel in [int(p) for p in args.parallel.split(",")]:
+            print(f"正在以--parallel {parallel}评测……")
+            reports[parallel] = run_grader(work_path, parallel, grade_args)
+        print_report(reports)
+        if args.report:
+            with open(args.report, "w", encoding="utf-8") as rf:
+                rf.write(json.dumps({"args": vars(args), "runs": reports}, ensure_ascii=False, indent=4))
+    finally:
+        if args.keep or args.work_dir:
+            print(f"工作文件夹保留于{work_path}。")
+        else:
+            shutil.rmtree(work_path, ignore_errors=True)
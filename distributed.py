@@ -0,0 +1,325 @@
+import os
+from os import path
+import json
+import socket
+import select
+import struct
+import base64
+import logging
+import queue
+import time
+import ipaddress
+from collections import deque
+from threading import Thread, Lock, Condition
+
+# 多机评测：协调者持有提交队列、配置与评测结果，评测机通过TCP或Unix套接字连接协调者，
+# 在各自的评测环境中评测提交，并将评测结果与评测脚本输出发回协调者。
+# 消息为4字节长度前缀加UTF-8编码的JSON，压缩包与日志以base64编码。
+
+logger = logging.getLogger()
+
+HEARTBEAT_INTERVAL = 10
+WORKER_TIMEOUT = 60
+
+
+def parse_address(address):
+    # "unix:/path/to/socket"或"host:port"，省略host时只监听本机。
+    if address.startswith("unix:"):
+        return socket.AF_UNIX, address[len("unix:"):]
+    host, _, port = address.rpartition(":")
+    return socket.AF_INET, (host or "127.0.0.1", int(port))
+
+
+def is_local_address(address):
+    # Unix套接字与本机回环地址只能从本机连接。
+    family, address_value = parse_address(address)
+    if family == socket.AF_UNIX:
+        return True
+    host = address_value[0]
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def send_message(sock, message):
+    data = json.dumps(message, ensure_ascii=False).encode()
+    sock.sendall(struct.pack(">I", len(data)) + data)
+
+
+def recv_exact(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("连接已关闭")
+        data += chunk
+    return bytes(data)
+
+
+def recv_message(sock):
+    size = struct.unpack(">I", recv_exact(sock, 4))[0]
+    return json.loads(recv_exact(sock, size).decode())
+
+
+class Coordinator:
+    # 每台评测机连接后获得一段全局评测环境编号，最多同时分配与其评测环境数量相同的提交。
+    # 评测机断开或超时未响应时，分配给它但尚未完成的提交重新加入队列。
+    def __init__(self, grader, address, token=None):
+        self.grader = grader
+        self.address = address
+        self.token = token
+        self.jobs = deque()
+        self.remaining = set()
+        self.lock = Lock()
+        self.changed = Condition(self.lock)
+        self.next_slot = 0
+        self.worker_threads = []
+
+    def run(self, student_filenames):
+        self.jobs.extend(student_filenames)
+        self.remaining = set(student_filenames)
+        if not self.remaining:
+            return
+        family, address = parse_address(self.address)
+        if family == socket.AF_UNIX and path.exists(address):
+            os.remove(address)
+        server = socket.socket(family, socket.SOCK_STREAM)
+        if family == socket.AF_INET:
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind(address)
+        server.listen()
+        logger.info(f"正在{self.address}上等待评测机连接，共{len(self.remaining)}份提交待评测。")
+        Thread(target=self.accept_loop, args=(server,), daemon=True).start()
+        with self.changed:
+            while self.remaining:
+                self.changed.wait()
+        server.close()
+        # 等待各连接通知评测机退出。
+        for worker_thread in list(self.worker_threads):
+            worker_thread.join(timeout=5)
+        if family == socket.AF_UNIX:
+            os.remove(address)
+        # 运行报告中的评测环境利用率按全部评测机的评测环境计算。
+        self.grader.parallel_count = max(self.next_slot, 1)
+
+    def accept_loop(self, server):
+        while True:
+            try:
+                conn, _ = server.accept()
+            except OSError:
+                return
+            worker_thread = Thread(target=self.serve_worker, args=(conn,), daemon=True)
+            self.worker_threads.append(worker_thread)
+            worker_thread.start()
+
+    def take_job(self):
+        with self.lock:
+            return self.jobs.popleft() if self.jobs else None
+
+    def serve_worker(self, conn):
+        inflight = set()
+        worker_name = "未知评测机"
+        try:
+            conn.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            conn.settimeout(WORKER_TIMEOUT)
+            join = recv_message(conn)
+            last_heard = time.monotonic()
+            if join.get("type") != "join" or (self.token and join.get("token") != self.token):
+                logger.warning(f"拒绝了未通过验证的评测机连接。")
+                send_message(conn, {"type": "reject"})
+                return
+            slots = max(1, int(join["slots"]))
+            worker_name = join.get("name", worker_name)
+            with self.lock:
+                slot_base = self.next_slot
+                self.next_slot += slots
+            logger.info(f"评测机{worker_name}已连接，提供{slots}个评测环境（全局编号{slot_base}~{slot_base + slots - 1}）。")
+            send_message(conn, {"type": "welcome", "config": self.worker_config(), "slot_base": slot_base})
+
+            # 评测机构造好评测环境后才分配提交。评测机有已分配的提交，但心跳表明其既未在评测也没有待评测的提交时，视为失去响应。
+            ready = False
+            idle_since = None
+            while True:
+                while ready and len(inflight) < slots:
+                    student_file = self.take_job()
+                    if student_file is None:
+                        break
+                    with open(path.join(self.grader.stu_files_folder, student_file), "rb") as sf:
+                        archive = base64.b64encode(sf.read()).decode()
+                    send_message(conn, {"type": "job", "file": student_file, "archive": archive})
+                    inflight.add(student_file)
+                with self.lock:
+                    finished = not self.remaining
+                if finished:
+                    send_message(conn, {"type": "exit"})
+                    return
+                # 每秒检查一次是否有新的提交可以分配或评测已全部完成。
+                if not select.select([conn], [], [], 1)[0]:
+                    if time.monotonic() - last_heard > WORKER_TIMEOUT:
+                        raise ConnectionError(f"{WORKER_TIMEOUT}秒内没有响应")
+                    continue
+                message = recv_message(conn)
+                last_heard = time.monotonic()
+                if message["type"] == "heartbeat":
+                    if not inflight or message.get("active") or message.get("queued"):
+                        idle_since = None
+                    elif idle_since is None:
+                        idle_since = last_heard
+                    elif last_heard - idle_since > WORKER_TIMEOUT:
+                        raise ConnectionError(f"{WORKER_TIMEOUT}秒内没有评测已分配的提交")
+                    continue
+                idle_since = None
+                # 评测机只能汇报分配给它且尚未完成的提交。
+                if message["type"] == "report" and (not message["args"] or message["args"][0] not in inflight):
+                    raise ValueError(f"评测机汇报了未分配给它的提交{message['args'][:1]}")
+                if message["type"] == "done" and message["file"] not in inflight:
+                    raise ValueError(f"评测机汇报了未分配给它的提交{message['file']}")
+                if message["type"] == "ready":
+                    ready = True
+                elif message["type"] == "report":
+                    self.apply_report(message["method"], message["args"], slot_base)
+                elif message["type"] == "done":
+                    if message.get("log_name"):
+                        with open(path.join(self.grader.config.script_output, path.basename(message["log_name"])), "wb") as lf:
+                            lf.write(base64.b64decode(message["log"]))
+                    inflight.discard(message["file"])
+                    with self.changed:
+                        self.remaining.discard(message["file"])
+                        self.changed.notify_all()
+        except (OSError, ConnectionError, ValueError, KeyError) as e:
+            if inflight:
+                logger.error(f"评测机{worker_name}失去连接（{e}），{len(inflight)}份提交将重新分配。")
+        finally:
+            conn.close()
+            with self.changed:
+                for student_file in inflight:
+                    if student_file in self.remaining:
+                        self.jobs.appendleft(student_file)
+                self.changed.notify_all()
+
+    def worker_config(self):
+        # 查重在协调者上进行，模板与已知解答的路径是协调者上的绝对路径，不发送给评测机。
+        config = dict(self.grader.config)
+        config["plagiarism_test"] = {file: {"template": "", "known_solutions": []} for file in config["plagiarism_test"]}
+        return config
+
+    def apply_report(self, method, args, slot_base):
+        if method == "record_timing":
+            # 评测机的评测环境编号与时间换算为协调者的全局编号与时间。
+            student_file, env_id, start, end, phases, outcome = args
+            now = time.monotonic() - self.grader.run_start
+            args = [student_file, slot_base + env_id, now - (end - start), now, phases, outcome]
+        if method not in ("record_result", "record_build_cache_stats", "record_timing"):
+            raise ValueError(f"不支持的评测结果{method}")
+        getattr(self.grader, method)(*args)
+
+
+def run_worker(address, slots, token, make_grader):
+    # make_grader(config)根据协调者下发的配置构造本地的Grader。
+    family, address_value = parse_address(address)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.connect(address_value)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    send_message(sock, {"type": "join", "slots": slots, "token": token, "name": f"{socket.gethostname()}:{os.getpid()}"})
+    welcome = recv_message(sock)
+    if welcome.get("type") != "welcome":
+        logger.fatal("协调者拒绝了连接，请检查--token。")
+        return
+
+    # 评测结果经由report_queue交给发送线程，与子进程评测时的结果汇报方式相同。
+    outbox = queue.Queue()
+    jobs = queue.Queue()
+    send_lock = Lock()
+    # 各评测环境正在评测的提交，随心跳发送，供协调者确认评测机确实在评测。
+    active = {}
+
+    def sender():
+        while True:
+            try:
+                item = outbox.get(timeout=HEARTBEAT_INTERVAL)
+            except queue.Empty:
+                item = {"type": "heartbeat", "active": list(active.values()), "queued": jobs.qsize()}
+            if item is None:
+                return
+            if isinstance(item, tuple):
+                method, args = item
+                item = {"type": "report", "method": method, "args": list(args)}
+            try:
+                with send_lock:
+                    send_message(sock, item)
+            except OSError:
+                return
+
+    def slot_worker(env_id):
+        while True:
+            student_file = jobs.get()
+            if student_file is None:
+                return
+            active[env_id] = student_file
+            try:
+                grader.grade_job(env_id, student_file)
+            finally:
+                active.pop(env_id, None)
+            try:
+                os.remove(path.join(grader.stu_files_folder, student_file))
+            except OSError:
+                pass
+            done = {"type": "done", "file": student_file}
+            log_path = grader.log_path(student_file)
+            if path.exists(log_path):
+                with open(log_path, "rb") as lf:
+                    done["log"] = base64.b64encode(lf.read()).decode()
+                done["log_name"] = path.basename(log_path)
+            outbox.put(done)
+
+    # 构造评测环境可能需要较长时间，期间也要发送心跳。
+    # 构造失败（包括配置错误时的exit）时同样要停止发送心跳并关闭连接，使协调者重新分配已发送的提交。
+    sender_thread = Thread(target=sender)
+    sender_thread.start()
+    slot_threads = []
+    try:
+        try:
+            grader = make_grader(welcome["config"])
+            grader.setup_env()
+            grader.stu_files_folder = path.join(grader.grading_env_path, "worker_inbox")
+            os.makedirs(grader.stu_files_folder, exist_ok=True)
+        except Exception as e:
+            logger.fatal(f"评测机构造评测环境失败：{e}")
+            return
+        grader.run_start = time.monotonic()
+        grader.report_queue = outbox
+
+        slot_threads = [Thread(target=slot_worker, args=(env_id,)) for env_id in range(slots)]
+        for slot_thread in slot_threads:
+            slot_thread.start()
+        outbox.put({"type": "ready"})
+        while True:
+            message = recv_message(sock)
+            if message["type"] == "exit":
+                break
+            if message["type"] == "job":
+                student_file = path.basename(message["file"])
+                with open(path.join(grader.stu_files_folder, student_file), "wb") as af:
+                    af.write(base64.b64decode(message["archive"]))
+                logger.debug(f"收到待评测的提交{student_file}。")
+                jobs.put(student_file)
+    except (OSError, ConnectionError) as e:
+        logger.error(f"与协调者的连接中断：{e}")
+    finally:
+        # 尚未开始评测的提交会由协调者重新分配。
+        while True:
+            try:
+                jobs.get_nowait()
+            except queue.Empty:
+                break
+        for _ in slot_threads:
+            jobs.put(None)
+        for slot_thread in slot_threads:
+            slot_thread.join()
+        outbox.put(None)
+        sender_thread.join()
+        sock.close()
+    logger.info("评测机已退出。")
@@ -7,14 +7,29 @@ import argparse
 from posixpath import isabs
 import subprocess
 import shutil
-from threading import Thread, Semaphore, Lock
+from threading import Thread, Lock, Event
+import multiprocessing
+import queue
+import gzip
+import atexit
+from logging.handlers import QueueHandler, QueueListener
+import time
+import math
+import datetime
+import signal
+import resource
 import re
-import glob
 import zipfile
+import io
 import csv
+import hashlib
 import mosspy
+from plagiarism import LocalChecker, FingerprintCorpus, fingerprint
+from distributed import Coordinator, run_worker, is_local_address
 
 LESSDEBUG_LOG_LEVEL = 15
+# ccache 3.x与4.x中表示命中缓存的计数器。
+BUILD_CACHE_HIT_COUNTERS = {"direct_cache_hit", "preprocessed_cache_hit", "cache_hit_direct", "cache_hit_preprocessed"}
 
 class CustomFormatter(logging.Formatter):
     grey        = "\x1b[90m"
@@ -48,12 +63,76 @@ def less_debug(self, message, *args, **kws):
 
 ch = logging.StreamHandler()
 logger = logging.getLogger()
+# 各工作者只将日志放入队列，由单独的线程写入终端，避免工作者在终端输出上互相等待。
+log_queue = queue.Queue()
+queue_handler = QueueHandler(log_queue)
 
 class DotDict(dict):
     __getattr__ = dict.get
     __setattr__ = dict.__setitem__
     __delattr__ = dict.__delitem__
 
+class LogSink:
+    # 评测脚本的输出直接流式写入日志文件，可选gzip压缩；超过大小上限后截断，但仍继续读取输出以匹配得分。
+    def __init__(self, file_path, compress, max_size):
+        self.file = gzip.open(file_path, "wb") if compress else open(file_path, "wb")
+        self.max_size = max_size
+        self.written = 0
+        self.truncated = False
+        self.lock = Lock()
+
+    def write(self, data):
+        with self.lock:
+            if self.truncated:
+                return
+            if self.max_size and self.written + len(data) > self.max_size:
+                data = data[:self.max_size - self.written]
+                self.truncated = True
+            self.file.write(data)
+            self.written += len(data)
+            if self.truncated:
+                self.file.write(f"\n===== 日志超过{self.max_size}字节，已截断 =====\n".encode())
+
+    def close(self):
+        self.file.close()
+
+
+class PhaseTimer:
+    # 记录一份提交评测过程中各阶段的耗时。每次lap记录自上一次lap以来经过的时间。
+    def __init__(self):
+        self.phases = {}
+        self.outcome = "graded"
+        self.last = time.monotonic()
+
+    def lap(self, phase, now=None):
+        now = time.monotonic() if now is None else now
+        self.phases[phase] = self.phases.get(phase, 0) + now - self.last
+        self.last = now
+
+
+class SubmissionIndex:
+    # 学生提交文件的索引。解压时记录各文件，此后按文件名查找候选文件。
+    def __init__(self, root):
+        self.root = root
+        self.files = {}
+
+    def add(self, file_path):
+        try:
+            size = os.stat(file_path).st_size
+        except OSError:
+            return
+        self.files.setdefault(path.basename(file_path), {})[file_path] = size
+
+    def lookup(self, file_name):
+        # 存在多个同名文件时，优先选择目录层级最浅的，其次是最大的，最后按路径排序，保证结果确定。
+        candidates = self.files.get(file_name, {})
+        return sorted(candidates, key=lambda f: (
+            path.relpath(f, self.root).count(os.sep),
+            -candidates[f],
+            f
+        ))
+
+
 class Grader:
     # args.parallel: Parallel grading job count.
     # args.config: DotDict file path. Normally under config/ folder.
@@ -61,9 +140,17 @@ class Grader:
         logger.info("正在初始化批量评测脚本……")
         self.parallel_count = args.parallel
         self.real_path = path.dirname(os.path.realpath(__file__))
-        self.grading_env_path = path.join(self.real_path, "grading_envs")
-        self.moss_path = path.join(self.real_path, "moss_path")
-        self.clean_xv6_path = path.join(self.grading_env_path, "clean_xv6")
+        # 评测环境与各类缓存所在的文件夹，默认为grade.py所在目录。
+        self.state_path = path.realpath(args.state_dir) if args.state_dir else self.real_path
+        self.grading_env_path = path.join(self.state_path, "grading_envs")
+        # 各评测环境所在的文件夹，可以位于tmpfs等内存文件系统中。
+        self.workspace_root = path.realpath(args.workspace_root) if args.workspace_root else None
+        self.workspace_path = self.workspace_root or self.grading_env_path
+        self.slot_memory = args.slot_memory
+        self.reference_size = 0
+        self.env_locations = {}
+        self.moss_path = path.join(self.state_path, "moss_path")
+        self.reference_cache_path = path.join(self.state_path, "reference_cache")
         self.config_file = args.config if path.isabs(args.config) else path.join(self.real_path, args.config)
         self.config_file_base = path.dirname(path.realpath(self.config_file))
         self.stu_files_folder = args.student_files if path.isabs(args.student_files) else path.join(self.real_path, args.student_files)
@@ -71,6 +158,37 @@ class Grader:
         self.codex = args.codex
         self.plagiarism_threshold = args.plagiarism_threshold
         self.anonymous = args.anonymous
+        self.resume = args.resume
+        self.corpus_tag = args.corpus_tag
+        self.corpus_path = None
+        self.order = args.order
+        self.use_processes = args.processes
+        self.watch = args.watch
+        self.watch_interval = args.watch_interval
+        if self.watch and self.use_processes:
+            logger.warning("--watch不支持--processes，将在线程中执行评测。")
+            self.use_processes = False
+        self.serve = args.serve
+        self.token = args.token
+        if self.watch and self.serve:
+            logger.warning("--watch不支持--serve，将在本机评测。")
+            self.serve = None
+        self.timing_history_path = path.join(self.state_path, "timing_history.json")
+        self.journal_path = path.join(self.output_dir, "journal.jsonl")
+        self.journal = None
+        self.timings_path = path.join(self.output_dir, "timings.jsonl")
+        self.timings_log = None
+        self.run_report_path = path.join(self.output_dir, "run_report.json")
+        self.workspace_mode = args.workspace_mode
+        self.populate_mode = args.populate
+        self.build_cache = args.build_cache
+        self.build_cache_path = path.join(self.state_path, "build_cache")
+        self.build_cache_bin_path = path.join(self.grading_env_path, "ccache_bin")
+        self.result_cache = not args.no_result_cache
+        self.regrade = args.regrade
+        self.result_cache_path = path.join(self.state_path, "result_cache")
+        self.log_gzip = args.log_gzip
+        self.log_max_size = args.log_max_size
         try:
             with open(self.config_file, "r") as cf:
                 self.config = DotDict(json.loads(cf.read()))
@@ -89,6 +207,50 @@ class Grader:
                     self.config.moss_report_path = "moss_report"
                 if not path.isabs(self.config.moss_report_path):
                     self.config.moss_report_path = path.join(self.real_path, self.config.moss_report_path)
+                self.config.extract_limits = DotDict({
+                    "max_entries": 20000,
+                    "max_member_size": 64 * 1024 * 1024,
+                    "max_total_size": 512 * 1024 * 1024,
+                    "max_depth": 4,
+                    **(self.config.extract_limits or {})
+                })
+                self.config.limits = DotDict({
+                    "wall_time": 0,
+                    "cpu_time": 0,
+                    "memory": 0,
+                    "output_size": 0,
+                    **(self.config.limits or {})
+                })
+                if args.timeout is not None:
+                    self.config.limits.wall_time = args.timeout
+                if not self.config.plagiarism_backend:
+                    self.config.plagiarism_backend = "moss"
+                self.config.local_plagiarism = DotDict({
+                    "k": 10,
+                    "window": 6,
+                    "max_doc_freq": 0.5,
+                    "max_postings": 100,
+                    **(self.config.local_plagiarism or {})
+                })
+                if self.config.fingerprint_corpus:
+                    self.corpus_path = self.config.fingerprint_corpus if path.isabs(self.config.fingerprint_corpus) else path.join(self.real_path, self.config.fingerprint_corpus)
+                if not self.config.cache_compilers:
+                    self.config.cache_compilers = ["riscv64-unknown-elf-gcc", "riscv64-linux-gnu-gcc", "riscv64-elf-gcc"]
+                self.config.test_cases = [DotDict(case) for case in self.config.test_cases or []]
+                if not self.config.case_regex:
+                    self.config.case_regex = self.config.result_regex
+                if self.config.preflight:
+                    self.config.preflight = DotDict({
+                        "command": None,
+                        "files": [f for f in list(self.config.new_file) + list(self.config.alter_file) if f.endswith(".c")],
+                        "required": [],
+                        "timeout": 60,
+                        **self.config.preflight
+                    })
+                    unknown_files = [f for f in self.config.preflight.files + self.config.preflight.required if f not in self.config.new_file and f not in self.config.alter_file]
+                    if unknown_files:
+                        logger.fatal(f"preflight中的文件{unknown_files}不在new_file或alter_file中。")
+                        exit(0)
         except FileNotFoundError:
             logger.fatal("未找到对应配置文件。")
             exit(0)
@@ -96,138 +258,987 @@ class Grader:
             logger.fatal("配置文件不是合法的JSON文件。")
             exit(0)
         logger.verbose("已加载配置文件。")
+        # 同一仓库与分支的干净评测环境在多次运行之间复用。
+        reference_key = hashlib.sha1(f"{self.config.repo}\0{self.config.branch}".encode()).hexdigest()[:16]
+        self.clean_xv6_path = path.join(self.reference_cache_path, reference_key)
+        self.clean_tracked_files = set()
+        # 干净评测环境（不含.git）中各文件的大小与修改时间，复用评测环境时据此还原。
+        self.clean_files = {}
+        self.clean_dirs = set()
+        # 解压时只需要这些文件。
+        self.wanted_files = set(self.config.plagiarism_test) | set(self.config.new_file) | set(self.config.alter_file)
         self.explain_config()
-        self.semaphore = Semaphore(self.parallel_count)
         self.env_available = []
         for i in range(0, self.parallel_count):
             self.env_available.append(Lock())
         self.result_mutex = Lock()
-        self.output_mutex = Lock()
         self.results = {}
+        self.build_cache_stats = {}
+        self.durations = {}
+        self.env_cache_keys = {}
+        self.env_timers = {}
+        self.timings = []
+        self.run_start = None
+        self.report_queue = None
+        self.result_cache_inflight = {}
+        self.result_cache_fresh = set()
+        self.clean_commit = None
+        self.reference_stamp = None
         self.bad_files = []
+        self.recorded_count = 0
         self.report_url = {}
+        self.local_pairs = {}
+        self.plagiarism_thread = None
     
 
     def setup_env(self):
         logger.info("正在构造评测环境……")
 
-        if os.path.exists(self.grading_env_path):
-            shutil.rmtree(self.grading_env_path)
+        os.makedirs(self.grading_env_path, exist_ok=True)
+        os.makedirs(self.workspace_path, exist_ok=True)
+        os.makedirs(self.reference_cache_path, exist_ok=True)
+        self.update_reference()
         
-        os.mkdir(self.grading_env_path)
-        os.mkdir(self.clean_xv6_path)
+        if self.result_cache and not path.exists(self.result_cache_path):
+            os.mkdir(self.result_cache_path)
+        
+        tracked = subprocess.check_output(["git", "ls-files", "-z"], cwd=self.clean_xv6_path)
+        self.clean_tracked_files = set(f.decode() for f in tracked.split(b'\0') if f)
 
-        logger.debug("正在下载实验测试环境……")
-        try:
-            subprocess.check_output(["git", "clone", "-b", self.config.branch, self.config.repo, self.clean_xv6_path])
-        except subprocess.CalledProcessError:
-            logger.fatal("实验测试环境配置失败。")
-            exit(0)
+        if self.build_cache:
+            self.setup_build_cache()
+
+        self.prebuild_reference()
+        for dir_path, dir_names, file_names in os.walk(self.clean_xv6_path):
+            rel_dir = path.relpath(dir_path, self.clean_xv6_path)
+            if rel_dir == ".":
+                dir_names[:] = [d for d in dir_names if d != ".git"]
+            else:
+                self.clean_dirs.add(rel_dir)
+            for file_name in file_names:
+                stat = os.lstat(path.join(dir_path, file_name))
+                self.clean_files[path.normpath(path.join(rel_dir, file_name))] = (stat.st_size, stat.st_mtime_ns)
+        
+        # 评测环境由其他版本的干净评测环境构造时，需要重新构造。
+        self.reference_stamp = json.dumps({"commit": self.clean_commit, "prebuild": self.config.prebuild, "populate": self.populate_mode})
+        for env_base in dict.fromkeys([self.workspace_path, self.grading_env_path]):
+            for env_dir in os.listdir(env_base):
+                env_path = path.join(env_base, env_dir)
+                if not re.match(r"^env[0-9]+$", env_dir):
+                    continue
+                if self.workspace_mode == "copy" or self.read_stamp(path.join(env_path, "reference_stamp")) != self.reference_stamp:
+                    shutil.rmtree(env_path)
+
+        if self.workspace_root:
+            # 评测环境所需空间按干净评测环境的大小加上提交中需要解压的文件的大小估计。
+            for dir_path, _, file_names in os.walk(self.clean_xv6_path):
+                for file_name in file_names:
+                    self.reference_size += os.lstat(path.join(dir_path, file_name)).st_size
+            logger.debug(f"评测环境位于{self.workspace_root}，干净评测环境大小为{self.reference_size}字节。")
+            atexit.register(self.cleanup_workspace)
         
         logger.debug("正在构造查重检查文件夹……")
         
-        if os.path.exists(self.moss_path):
+        # 继续评测时保留此前已复制的查重文件与评测输出。
+        if os.path.exists(self.moss_path) and not self.resume:
             shutil.rmtree(self.moss_path)
-        os.mkdir(self.moss_path)
+        os.makedirs(self.moss_path, exist_ok=True)
 
         for file, conf in self.config.plagiarism_test.items():
-            os.mkdir(path.join(self.moss_path, file))
+            os.makedirs(path.join(self.moss_path, file), exist_ok=True)
             for sol in conf.known_solutions:
                 shutil.copy(sol, path.join(self.moss_path, file))
         
-        if os.path.exists(self.config.script_output):
+        if os.path.exists(self.config.script_output) and not self.resume:
             shutil.rmtree(self.config.script_output)
-        os.mkdir(self.config.script_output)
+        os.makedirs(self.config.script_output, exist_ok=True)
+
+    def update_reference(self):
+        if path.exists(path.join(self.clean_xv6_path, ".git")):
+            logger.debug("正在检查已缓存的实验测试环境是否为最新版本……")
+            try:
+                subprocess.check_output(["git", "fetch", "-q", "origin", self.config.branch], cwd=self.clean_xv6_path, stderr=subprocess.STDOUT)
+                local_commit = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=self.clean_xv6_path).decode().strip()
+                remote_commit = subprocess.check_output(["git", "rev-parse", "FETCH_HEAD"], cwd=self.clean_xv6_path).decode().strip()
+                if local_commit != remote_commit:
+                    logger.info(f"实验测试环境已更新至{remote_commit}。")
+                    subprocess.check_output(["git", "reset", "-q", "--hard", "FETCH_HEAD"], cwd=self.clean_xv6_path)
+                    subprocess.check_output(["git", "clean", "-q", "-f", "-d", "-x"], cwd=self.clean_xv6_path)
+            except subprocess.CalledProcessError as e:
+                logger.warning(f"无法更新已缓存的实验测试环境，将直接使用：{e.output}")
+        else:
+            if path.exists(self.clean_xv6_path):
+                shutil.rmtree(self.clean_xv6_path)
+            logger.debug("正在下载实验测试环境……")
+            try:
+                subprocess.check_output(["git", "clone", "-b", self.config.branch, self.config.repo, self.clean_xv6_path])
+            except subprocess.CalledProcessError:
+                logger.fatal("实验测试环境配置失败。")
+                exit(0)
+        self.clean_commit = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=self.clean_xv6_path).decode().strip()
+
+
+    def prebuild_reference(self):
+        # 预编译结果记录在.git目录中，提交与预编译命令均未改变时无需重新编译。
+        prebuilt_stamp_path = path.join(self.clean_xv6_path, ".git", "autograde_prebuilt")
+        prebuilt_stamp = json.dumps({"commit": self.clean_commit, "prebuild": self.config.prebuild})
+        if self.read_stamp(prebuilt_stamp_path) == prebuilt_stamp:
+            logger.debug("已缓存的实验测试环境无需重新预编译。")
+            return
+        subprocess.check_output(["git", "clean", "-q", "-f", "-d", "-x"], cwd=self.clean_xv6_path)
+        if self.config.prebuild:
+            logger.debug("正在预编译实验测试环境……")
+            try:
+                subprocess.check_output(self.config.prebuild, cwd=self.clean_xv6_path, env=self.build_env(self.clean_xv6_path), stderr=subprocess.STDOUT)
+            except (subprocess.CalledProcessError, OSError) as e:
+                logger.fatal(f"实验测试环境预编译失败：{e}")
+                exit(0)
+        with open(prebuilt_stamp_path, "w") as sf:
+            sf.write(prebuilt_stamp)
+
+
+    def read_stamp(self, stamp_path):
+        try:
+            with open(stamp_path, "r") as sf:
+                return sf.read()
+        except OSError:
+            return None
+
+
+    def setup_build_cache(self):
+        ccache = shutil.which("ccache")
+        if not ccache:
+            logger.warning("未找到ccache，将不使用编译缓存。")
+            self.build_cache = False
+            return
+        
+        logger.debug("正在配置编译缓存……")
+        if not path.exists(self.build_cache_path):
+            os.mkdir(self.build_cache_path)
+        if path.exists(self.build_cache_bin_path):
+            shutil.rmtree(self.build_cache_bin_path)
+        os.mkdir(self.build_cache_bin_path)
+        # ccache通过与编译器同名的符号链接被调用时，会自动在PATH中查找真正的编译器。
+        for compiler in self.config.cache_compilers:
+            os.symlink(ccache, path.join(self.build_cache_bin_path, compiler))
+    
+
+    def build_env(self, base_dir, stats_log=None):
+        if not self.build_cache:
+            return None
+        env = dict(os.environ)
+        env["PATH"] = self.build_cache_bin_path + os.pathsep + env.get("PATH", "")
+        env["CCACHE_DIR"] = self.build_cache_path
+        # 以评测环境根目录为基准使用相对路径计算哈希，使不同评测环境之间可以共享缓存。
+        env["CCACHE_BASEDIR"] = base_dir
+        env["CCACHE_NOHASHDIR"] = "1"
+        env["CCACHE_SLOPPINESS"] = "include_file_mtime,include_file_ctime"
+        if stats_log:
+            env["CCACHE_STATSLOG"] = stats_log
+        return env
+
+
+    def read_build_cache_stats(self, stats_log):
+        # 每次编译在日志中写入一条以"# 源文件"开头的记录，其后为本次编译的各项计数器，
+        # ccache 4.x会同时写入direct_cache_miss、local_storage_miss等多项，因此按记录而非按行统计。
+        hits, misses = 0, 0
+        records = []
+        try:
+            with open(stats_log, "r") as sf:
+                for line in sf:
+                    line = line.strip()
+                    if line.startswith("#") or not records:
+                        records.append(set())
+                    if line and not line.startswith("#"):
+                        records[-1].add(line)
+            os.remove(stats_log)
+        except OSError:
+            pass
+        for counters in records:
+            if counters & BUILD_CACHE_HIT_COUNTERS:
+                hits += 1
+            elif "cache_miss" in counters:
+                misses += 1
+        return hits, misses
+
 
     def batch_grade(self):
         logger.info("开始准备批量评测……")
         logger.debug("正在读取提交文件……")
-        student_filenames = [f for f in os.listdir(self.stu_files_folder)]
-        threads = []
-        for f in student_filenames:
-            self.semaphore.acquire()
-            env = self.alloc_env()
-            logger.verbose(f"检测到提交文件{f}，使用{env}号评测环境。")
-            t = Thread(target=self.single_grade, args=(env, f))
-            threads.append(t)
-            t.start()
-        for t in threads:
-            t.join()
+        self.open_journal()
+        student_filenames = [f for f in os.listdir(self.stu_files_folder) if not f in self.results and not f in self.bad_files]
+        logger.verbose(f"检测到{len(student_filenames)}份待评测的提交文件。")
+        self.run_start = time.monotonic()
+        self.run_workers(self.order_submissions(student_filenames))
+        self.save_timing_history()
+        self.write_run_report(time.monotonic() - self.run_start)
+        if self.build_cache_stats:
+            total_hits = sum(hits for hits, _ in self.build_cache_stats.values())
+            total_misses = sum(misses for _, misses in self.build_cache_stats.values())
+            logger.info(f"编译缓存共命中{total_hits}次，未命中{total_misses}次。")
+        self.journal.close()
+        self.timings_log.close()
         logger.info("评测已全部完成。开始导出成绩与执行失败列表。")
+        self.export_results()
+    
+
+    def open_journal(self):
+        # 每份提交评测完成后立即追加写入评测日志，程序中断后可以通过--resume继续评测。
+        if not path.exists(self.output_dir):
+            os.mkdir(self.output_dir)
+        if self.resume:
+            for file_name, entry in self.read_journal().items():
+                if entry["score"] is not None:
+                    self.results[file_name] = (entry["score"], entry["err_msg"])
+                if entry["score"] is None or entry["score"] == 0:
+                    self.bad_files.append(file_name)
+            logger.info(f"已从评测日志中恢复{len(self.results)}份提交的评测结果。")
+        self.journal = open(self.journal_path, "a" if self.resume else "w", encoding="utf-8")
+        if self.journal.tell() > 0:
+            # 保证新的记录从新的一行开始，不与中断时写入的半行拼接。
+            self.journal.write("\n")
+        self.timings_log = open(self.timings_path, "a" if self.resume else "w", encoding="utf-8")
+        if self.timings_log.tell() > 0:
+            with open(self.timings_path, "rb") as tf:
+                tf.seek(-1, os.SEEK_END)
+                if tf.read(1) != b"\n":
+                    self.timings_log.write("\n")
+
+
+    def read_journal(self):
+        entries = {}
+        try:
+            with open(self.journal_path, "r", encoding="utf-8") as jf:
+                for line in jf:
+                    try:
+                        entry = json.loads(line)
+                    except JSONDecodeError:
+                        # 中断时可能只写入了半行，忽略即可。
+                        continue
+                    # 同一提交被重新评测时，以最后一次的结果为准，并按最后一次评测的顺序排列。
+                    entries.pop(entry["file"], None)
+                    entries[entry["file"]] = entry
+        except FileNotFoundError:
+            pass
+        return entries
+
+
+    def record_result(self, student_file, score, err_msg):
+        # score为None表示提交文件不符合命名规则。
+        entry = {"file": student_file, "score": score, "err_msg": ";".join(err_msg)}
+        self.result_mutex.acquire()
+        self.journal.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+        if score is not None:
+            self.results[student_file] = (score, entry["err_msg"])
+        if score is None or score == 0:
+            if student_file not in self.bad_files:
+                self.bad_files.append(student_file)
+        elif student_file in self.bad_files:
+            # 重新提交后通过评测。
+            self.bad_files.remove(student_file)
+        self.recorded_count += 1
+        self.result_mutex.release()
+
+
+    def record_build_cache_stats(self, student_file, hits, misses):
+        self.result_mutex.acquire()
+        self.build_cache_stats[student_file] = (hits, misses)
+        self.result_mutex.release()
+
+
+    def record_timing(self, student_file, env_id, start, end, phases, outcome):
+        # start与end为相对于本次评测开始的秒数。
+        entry = {
+            "file": student_file, "env_id": env_id, "start": round(start, 3), "end": round(end, 3),
+            "duration": round(end - start, 3), "outcome": outcome,
+            "phases": {phase: round(seconds, 3) for phase, seconds in phases.items()},
+        }
+        self.result_mutex.acquire()
+        self.durations[student_file] = end - start
+        self.timings.append(entry)
+        self.timings_log.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self.timings_log.flush()
+        self.result_mutex.release()
+
+
+    @staticmethod
+    def percentile(values, fraction):
+        # 最近秩法，values需已排序。
+        return values[max(0, math.ceil(fraction * len(values)) - 1)]
+
+
+    def write_run_report(self, wall_time):
+        # 汇总本次运行的吞吐量、各评测环境的利用率、各阶段耗时分布以及耗时最长的提交。
+        busy = {env_id: 0 for env_id in range(self.parallel_count)}
+        phase_values = {}
+        outcomes = {}
+        for entry in self.timings:
+            busy[entry["env_id"]] = busy.get(entry["env_id"], 0) + entry["duration"]
+            outcomes[entry["outcome"]] = outcomes.get(entry["outcome"], 0) + 1
+            for phase, seconds in entry["phases"].items():
+                phase_values.setdefault(phase, []).append(seconds)
+        phases = {}
+        for phase, values in phase_values.items():
+            values.sort()
+            phases[phase] = {
+                "count": len(values), "total": round(sum(values), 3), "p50": self.percentile(values, 0.5),
+                "p95": self.percentile(values, 0.95), "max": values[-1],
+            }
+        utilization = {str(env_id): round(seconds / wall_time, 3) if wall_time else 0 for env_id, seconds in busy.items()}
+        report = {
+            "submissions": len(self.timings),
+            "outcomes": outcomes,
+            "parallel": self.parallel_count,
+            "wall_time": round(wall_time, 3),
+            "throughput_per_minute": round(len(self.timings) * 60 / wall_time, 2) if wall_time else 0,
+            "slot_utilization": utilization,
+            "mean_utilization": round(sum(busy.values()) / wall_time / len(busy), 3) if wall_time and busy else 0,
+            "phases": phases,
+            "slowest": sorted(self.timings, key=lambda entry: entry["duration"], reverse=True)[:10],
+        }
+        with open(self.run_report_path, "w", encoding="utf-8") as rf:
+            rf.write(json.dumps(report, ensure_ascii=False, indent=4))
+        logger.info(f"本次共评测{report['submissions']}份提交，用时{report['wall_time']}秒，"
+                    f"每分钟{report['throughput_per_minute']}份，评测环境平均利用率{report['mean_utilization']:.0%}。")
+        logger.debug(f"运行报告已保存至{self.run_report_path}。")
+
+
+    def export_results(self):
         try:
-            if not path.exists(self.output_dir):
-                os.mkdir(self.output_dir)
+            entries = self.read_journal()
+            if self.watch:
+                entries = self.latest_entries(entries)
             score_path = path.join(self.output_dir, "score.csv")
             with open(score_path, "w", encoding=self.codex) as score_file:
                 writer = csv.writer(score_file)
                 writer.writerow(["学号", "姓名", "得分", "注释"])
-                for file_name, (score, err_msg) in self.results.items():
+                for file_name, entry in entries.items():
+                    if entry["score"] is None:
+                        continue
                     parse_regex = r"^([a-zA-Z0-9]{4,12})_([\w\u4e00-\u9fa5\u2000-\u206F]{2,30})_file\.zip$"
                     match_res = re.match(parse_regex, file_name)
-                    writer.writerow([match_res.groups()[0], match_res.groups()[1], score, err_msg])
+                    writer.writerow([match_res.groups()[0], match_res.groups()[1], entry["score"], entry["err_msg"]])
             logger.info(f"成绩已保存至{score_path}。")
             bad_path = path.join(self.output_dir, "bad_files.csv")
             with open(bad_path, "w", encoding=self.codex) as bad_list:
                 writer = csv.writer(bad_list)
-                for bad in self.bad_files:
-                    writer.writerow([bad,])
+                for file_name, entry in entries.items():
+                    if entry["score"] is None or entry["score"] == 0:
+                        writer.writerow([file_name,])
             logger.info(f"异常列表已保存至{bad_path}。")
         except Exception as e:
             logger.fatal(f"未能成功保存评测结果。错误信息如下：{e}")
     
 
+    def latest_entries(self, entries):
+        # 同一学生以不同的文件名重新提交时，只保留最后评测的一份。
+        latest = {}
+        for file_name, entry in entries.items():
+            key = self.submission_key(file_name)
+            latest.pop(key, None)
+            latest[key] = (file_name, entry)
+        return dict(latest.values())
+
+
+    def watch_grade(self):
+        # 持续监视学生文件夹，新增或被修改的提交在大小与修改时间稳定后加入评测队列，score.csv随评测结果更新。
+        logger.info(f"开始监视{self.stu_files_folder}，每{self.watch_interval}秒检查一次，按Ctrl+C停止。")
+        # 作为后台服务运行时，收到SIGTERM同样正常停止。
+        def stop_watching(signum, frame):
+            raise KeyboardInterrupt()
+        signal.signal(signal.SIGTERM, stop_watching)
+        self.open_journal()
+        self.run_start = time.monotonic()
+        jobs = queue.Queue()
+        # 已加入评测队列但尚未评测完成的学生。同一学生的新提交要等此前的提交评测完成后再加入队列，
+        # 否则先后两次评测同时进行，以较晚完成的结果为准，可能保留旧提交的得分。
+        self.watch_inflight = set()
+        workers = [Thread(target=self.watch_worker, args=(env_id, jobs)) for env_id in range(self.parallel_count)]
+        for worker in workers:
+            worker.start()
+
+        # 继续评测时，评测日志中已有的提交视为未改变。
+        seen = {f: sig for f, sig in self.scan_submissions().items() if f in self.results or f in self.bad_files}
+        pending = {}
+        exported_count = self.recorded_count
+        try:
+            while True:
+                current = self.scan_submissions()
+                for student_file, signature in current.items():
+                    if seen.get(student_file) == signature:
+                        continue
+                    # 上传中的文件仍在变化，等到两次检查之间不再变化时再评测。
+                    if pending.get(student_file) != signature:
+                        pending[student_file] = signature
+                        continue
+                    key = self.submission_key(student_file)
+                    with self.result_mutex:
+                        if key in self.watch_inflight:
+                            continue
+                        self.watch_inflight.add(key)
+                    del pending[student_file]
+                    logger.info(f"检测到{'更新的' if student_file in seen else '新的'}提交{student_file}，已加入评测队列。")
+                    seen[student_file] = signature
+                    jobs.put(student_file)
+                for student_file in list(seen):
+                    if student_file not in current:
+                        del seen[student_file]
+                if self.recorded_count != exported_count:
+                    exported_count = self.recorded_count
+                    self.export_results()
+                time.sleep(self.watch_interval)
+        except KeyboardInterrupt:
+            logger.info("停止监视，正在等待评测中的提交完成……")
+
+        # 尚未开始评测的提交留待下次继续。
+        while True:
+            try:
+                jobs.get_nowait()
+            except queue.Empty:
+                break
+        for _ in workers:
+            jobs.put(None)
+        for worker in workers:
+            worker.join()
+        self.save_timing_history()
+        self.write_run_report(time.monotonic() - self.run_start)
+        self.journal.close()
+        self.timings_log.close()
+        self.export_results()
+
+
+    def submission_key(self, student_file):
+        # 按学号区分学生，不符合命名规则的文件按文件名区分。
+        match_res = self.parse_student_file(student_file)
+        return match_res[0] if match_res else student_file
+
+
+    def scan_submissions(self):
+        submissions = {}
+        with os.scandir(self.stu_files_folder) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    stat = entry.stat()
+                    submissions[entry.name] = (stat.st_size, stat.st_mtime_ns)
+        return submissions
+
+
+    def start_plagiarism(self):
+        # 查重作为独立的流水线阶段，与评测同时进行。
+        if not self.config.plagiarism_test:
+            return
+        self.plagiarism_thread = Thread(target=self.plagiarism_pipeline)
+        self.plagiarism_thread.start()
+
+
+    def wait_plagiarism(self):
+        if self.plagiarism_thread:
+            self.plagiarism_thread.join()
+
+
+    def plagiarism_pipeline(self):
+        self.stage_plagiarism_files()
+        self.plagiarism_test()
+
+
+    def stage_plagiarism_files(self):
+        # 只从各提交中解压需要查重的文件，不必等待评测。
+        logger.debug("正在将需要查重的学生文件复制至查重文件夹……")
+        stage_path = path.join(self.grading_env_path, "plagiarism_stage")
+        for student_file in sorted(os.listdir(self.stu_files_folder)):
+            match_res = self.parse_student_file(student_file)
+            if not match_res:
+                continue
+            stu_id, name = match_res
+            if path.exists(stage_path):
+                shutil.rmtree(stage_path)
+            stu_index = SubmissionIndex(stage_path)
+            try:
+                with zipfile.ZipFile(path.join(self.stu_files_folder, student_file), 'r') as zip_ref:
+                    self.extract_zip(zip_ref, stage_path, stu_index, DotDict(entries=0, size=0), 0)
+            except Exception as e:
+                logger.verbose(f"无法解压{name}（{stu_id}）的提交文件以进行查重：{e}")
+            for file in self.config.plagiarism_test:
+                self.find_copy(file, stu_index, path.join(self.moss_path, file, f"{stu_id}_{name}_{file}"))
+        if path.exists(stage_path):
+            shutil.rmtree(stage_path)
+        logger.info("需要查重的学生文件已全部复制至查重文件夹，开始代码查重。")
+
+
     def plagiarism_test(self):
+        # 各文件的查重同时进行，每份查重报告完成后立即生成可视化结果。
+        reports = queue.Queue()
+        checkers = [Thread(target=self.check_plagiarism_file, args=(to_check, conf, reports)) for to_check, conf in self.config.plagiarism_test.items()]
+        for checker in checkers:
+            checker.start()
+        for _ in checkers:
+            to_check = reports.get()
+            if to_check:
+                self.visualize_plagiarism(to_check)
+        for checker in checkers:
+            checker.join()
+
+
+    def check_plagiarism_file(self, to_check, conf, reports):
+        try:
+            if self.config.plagiarism_backend == "local":
+                self.local_plagiarism_test(to_check, conf)
+            else:
+                self.moss_plagiarism_test(to_check, conf)
+            reports.put(to_check)
+        except Exception as e:
+            logger.error(f"对{to_check}执行代码查重时出现错误：{e}")
+            reports.put(None)
+
+
+    def moss_plagiarism_test(self, to_check, conf):
+        logger.debug(f"开始对{to_check}执行代码查重。")
+        moss_client = mosspy.Moss(self.config.moss_userid, "c")
+        if conf.template:
+            moss_client.addBaseFile(conf.template)
+        for sol in conf.known_solutions:
+            moss_client.addFile(sol)
+        moss_client.addFilesByWildcard(f"{path.join(self.moss_path, to_check)}/*{to_check}")
+        logger.info(f"正在发送{to_check}的代码，以进行代码查重。")
+        report_url = moss_client.send()
+        logger.info(f"{to_check}的代码查重报告已生成，报告URL为{report_url}。")
+        self.report_url[to_check] = report_url
+    
+
+    def local_plagiarism_test(self, to_check, conf):
+        logger.debug(f"开始对{to_check}执行本地代码查重。")
+        options = self.config.local_plagiarism
+        base_sources = []
+        if conf.template:
+            with open(conf.template, "r", errors="replace") as tf:
+                base_sources.append(tf.read())
+        checker = LocalChecker(options.k, options.window, options.max_doc_freq, base_sources, options.max_postings)
+        check_dir = path.join(self.moss_path, to_check)
+        to_add = [sol for sol in conf.known_solutions] + [path.join(check_dir, f) for f in sorted(os.listdir(check_dir)) if f.endswith(to_check)]
+        digests = {}
+        for file_path in to_add:
+            with open(file_path, "rb") as sf:
+                source = sf.read()
+            digests[path.basename(file_path)] = hashlib.sha256(source).hexdigest()
+            checker.add(path.basename(file_path), source.decode(errors="replace"))
+        
+        pairs = checker.similar_pairs(self.plagiarism_threshold)
+        if self.corpus_path:
+            pairs += self.query_corpus(to_check, checker, digests)
+        report_path = f"{self.config.moss_report_path}_{to_check}.csv"
+        os.makedirs(path.dirname(report_path), exist_ok=True)
+        with open(report_path, "w", encoding=self.codex) as report_file:
+            writer = csv.writer(report_file)
+            writer.writerow(["文件1", "文件2", "文件1相似度", "文件2相似度", "共享指纹数"])
+            for pair in pairs:
+                writer.writerow(pair)
+        for name, other, percent, other_percent, _ in pairs:
+            logger.warning(f"{to_check}疑似抄袭：{name}与{other}（{percent}%/{other_percent}%）。")
+        logger.info(f"{to_check}的本地查重完成，共比较{len(checker.docs)}份文件，{len(pairs)}对超过阈值，报告位于{report_path}。")
+        self.report_url[to_check] = report_path
+        self.local_pairs[to_check] = pairs
+    
+
+    def open_corpus(self, to_check):
+        options = self.config.local_plagiarism
+        os.makedirs(self.corpus_path, exist_ok=True)
+        return FingerprintCorpus(path.join(self.corpus_path, f"{to_check}.sqlite3"), options.k, options.window, options.max_doc_freq, options.max_postings)
+
+
+    def query_corpus(self, to_check, checker, digests):
+        # 先与往届的指纹比较，再将本批次的文件加入指纹库。同一标签（本届）的文件已在批次内比较过，不再重复。
+        corpus = self.open_corpus(to_check)
+        logger.debug(f"正在与{to_check}的指纹库（{corpus.doc_count()}份文件）比较。")
+        pairs = []
+        added = 0
+        for name in sorted(checker.docs):
+            fingerprints = checker.docs[name]
+            for other, tag, count, other_count in corpus.query(fingerprints, self.corpus_tag, name, digests[name]):
+                percent = count * 100 // max(1, len(fingerprints))
+                other_percent = count * 100 // max(1, other_count)
+                if max(percent, other_percent) >= self.plagiarism_threshold:
+                    pairs.append((name, f"{tag}/{other}", percent, other_percent, count))
+            added += corpus.add(name, self.corpus_tag, digests[name], fingerprints)
+        logger.debug(f"已将{added}份{to_check}加入指纹库。")
+        corpus.close()
+        pairs.sort(key=lambda pair: max(pair[2], pair[3]), reverse=True)
+        return pairs
+
+
+    def import_corpus(self, source_dir):
+        # 将往届的查重文件夹（结构与moss_path相同）导入指纹库。
+        options = self.config.local_plagiarism
         for to_check, conf in self.config.plagiarism_test.items():
-            logger.debug(f"开始对{to_check}执行代码查重。")
-            moss_client = mosspy.Moss(self.config.moss_userid, "c")
+            base_sources = []
             if conf.template:
-                moss_client.addBaseFile(conf.template)
-            for sol in conf.known_solutions:
-                moss_client.addFile(sol)
-            moss_client.addFilesByWildcard(f"{path.join(self.moss_path, to_check)}/*{to_check}")
-            logger.info(f"正在发送{to_check}的代码，以进行代码查重。")
-            report_url = moss_client.send()
-            logger.info(f"{to_check}的代码查重报告已生成，报告URL为{report_url}。")
-            self.report_url[to_check] = report_url
-    
+                with open(conf.template, "r", errors="replace") as tf:
+                    base_sources.append(tf.read())
+            checker = LocalChecker(options.k, options.window, options.max_doc_freq, base_sources, options.max_postings)
+            check_dir = path.join(source_dir, to_check)
+            if not path.isdir(check_dir):
+                logger.warning(f"{check_dir}不存在，跳过{to_check}。")
+                continue
+            corpus = self.open_corpus(to_check)
+            added = 0
+            for f in sorted(os.listdir(check_dir)):
+                if not f.endswith(to_check):
+                    continue
+                with open(path.join(check_dir, f), "rb") as sf:
+                    source = sf.read()
+                fingerprints = fingerprint(source.decode(errors="replace"), options.k, options.window) - checker.base
+                added += corpus.add(f, self.corpus_tag, hashlib.sha256(source).hexdigest(), fingerprints)
+            logger.info(f"已将{added}份{to_check}以标签{self.corpus_tag}导入指纹库，指纹库现有{corpus.doc_count()}份文件。")
+            corpus.close()
 
-    def visualize_plagiarism(self):
-        logger.info(f"正在生成可视化查重结果...")
-        leading_cmd = ["mossum", "-f", "svg", "-t", ".*/(.*)_(.*)_.*", "-m", "-p", "90", "-o", f"{self.config.moss_report_path}"]
+
+    def visualize_local_plagiarism(self, to_check):
+        # 本地查重结果使用graphviz绘制，与mossum的输出类似：节点为学生，边为超过阈值的文件对。
+        if not shutil.which("dot"):
+            logger.warning("未找到graphviz的dot命令，无法生成可视化查重结果。")
+            return
+        labels = {}
+        def label(name):
+            if name not in labels:
+                match_res = re.match(r"^(.*)_(.*)_.*$", name)
+                if self.anonymous:
+                    labels[name] = f"{len(labels) + 1}"
+                else:
+                    labels[name] = "_".join(match_res.groups()) if match_res else name
+            return labels[name]
+        dot_path = f"{self.config.moss_report_path}_{to_check}.dot"
+        with open(dot_path, "w", encoding="utf-8") as dot_file:
+            dot_file.write("graph plagiarism {\n")
+            for name, other, percent, other_percent, _ in self.local_pairs[to_check]:
+                dot_file.write(f'  "{label(name)}" -- "{label(other)}" [label="{percent}%/{other_percent}%"];\n')
+            dot_file.write("}\n")
+        if subprocess.call(["dot", "-Tsvg", dot_path, "-o", f"{self.config.moss_report_path}_{to_check}.svg"]) == 0:
+            logger.info(f"{to_check}的可视化查重结果已生成于{self.config.moss_report_path}_{to_check}.svg")
+        else:
+            logger.info(f"{to_check}的可视化查重结果生成失败。")
+
+
+    def visualize_plagiarism(self, to_check):
+        if self.config.plagiarism_backend == "local":
+            self.visualize_local_plagiarism(to_check)
+            return
+        logger.info(f"正在生成{to_check}的可视化查重结果...")
+        output_path = f"{self.config.moss_report_path}_{to_check}"
+        leading_cmd = ["mossum", "-f", "svg", "-t", ".*/(.*)_(.*)_.*", "-m", "-p", "90", "-o", output_path]
         if self.anonymous:
             leading_cmd.append("-a")
-        mossum_proc = subprocess.Popen(leading_cmd + [url for _, url in self.report_url.items()], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        mossum_proc = subprocess.Popen(leading_cmd + [self.report_url[to_check]], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
         with mossum_proc.stdout:
             for line in iter(mossum_proc.stdout.readline, b''):
                 logging.debug(f"mossum output: {line}")
         exitcode = mossum_proc.wait() # 0 means success
         if exitcode == 0:
-            logger.info(f"可视化查重结果已生成于{self.config.moss_report_path}")
+            logger.info(f"{to_check}的可视化查重结果已生成于{output_path}")
         else:
-            logger.info(f"可视化查重结果生成失败。")
+            logger.info(f"{to_check}的可视化查重结果生成失败。")
 
     
-    def alloc_env(self):
-        for i, lock in enumerate(self.env_available):
-            if lock.acquire(blocking=False):
-                return i
+    def grade_job(self, env_id, student_file):
+        self.env_available[env_id].acquire()
+        start_time = time.monotonic()
+        timer = self.env_timers[env_id] = PhaseTimer()
+        try:
+            self.single_grade(env_id, student_file)
+        except Exception as e:
+            logger.error(f"评测{student_file}时出现未预期的错误：{e}")
+            self.report("record_result", student_file, 0, [f"评测时出现错误'{e}'"])
+            timer.outcome = "error"
+        finally:
+            # 评测异常中断时，也要唤醒等待同一份缓存结果的其他评测环境。
+            cache_key = self.env_cache_keys.pop(env_id, None)
+            if cache_key:
+                self.release_cache_key(cache_key)
+            self.env_available[env_id].release()
+        self.env_timers.pop(env_id, None)
+        end_time = time.monotonic()
+        timer.lap("record", end_time)
+        self.report("record_timing", student_file, env_id, start_time - self.run_start, end_time - self.run_start, timer.phases, timer.outcome)
+
+
+    def thread_worker(self, env_id, jobs):
+        while True:
+            try:
+                student_file = jobs.get_nowait()
+            except queue.Empty:
+                return
+            self.grade_job(env_id, student_file)
+
+
+    def watch_worker(self, env_id, jobs):
+        while True:
+            student_file = jobs.get()
+            if student_file is None:
+                return
+            try:
+                self.grade_job(env_id, student_file)
+            finally:
+                with self.result_mutex:
+                    self.watch_inflight.discard(self.submission_key(student_file))
+
+
+    def process_worker(self, env_id, jobs, reports):
+        # 子进程中没有负责输出日志的线程，直接写入终端。
+        logger.removeHandler(queue_handler)
+        logger.addHandler(ch)
+        self.report_queue = reports
+        while True:
+            student_file = jobs.get()
+            if student_file is None:
+                break
+            self.grade_job(env_id, student_file)
+        reports.put((None, ()))
+
+
+    def run_workers(self, student_filenames):
+        # 每个工作者独占一个评测环境，从任务队列中依次取出提交评测。
+        if self.serve:
+            Coordinator(self, self.serve, self.token).run(student_filenames)
+            return
+        if not self.use_processes:
+            jobs = queue.Queue()
+            for f in student_filenames:
+                jobs.put(f)
+            workers = [Thread(target=self.thread_worker, args=(env_id, jobs)) for env_id in range(self.parallel_count)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            return
         
-        logger.fatal("找不到空闲的评测环境。")
-        exit(0)
+        # 子进程负责评测，主进程只负责记录结果，避免解压、复制等操作与日志处理争用GIL。
+        context = multiprocessing.get_context("fork")
+        jobs = context.Queue()
+        reports = context.Queue()
+        for f in student_filenames:
+            jobs.put(f)
+        for _ in range(self.parallel_count):
+            jobs.put(None)
+        workers = [context.Process(target=self.process_worker, args=(env_id, jobs, reports)) for env_id in range(self.parallel_count)]
+        for worker in workers:
+            worker.start()
+        finished = 0
+        while finished < len(workers):
+            try:
+                method, report_args = reports.get(timeout=1)
+            except queue.Empty:
+                if not any(worker.is_alive() for worker in workers):
+                    logger.error("评测子进程异常退出，部分提交未完成评测，可以使用--resume继续评测。")
+                    break
+                continue
+            if method is None:
+                finished += 1
+            else:
+                getattr(self, method)(*report_args)
+        for worker in workers:
+            worker.join()
+
+
+    def report(self, method, *args):
+        # 在子进程中评测时，评测结果交由主进程统一记录。
+        if self.report_queue is not None:
+            self.report_queue.put((method, args))
+        else:
+            getattr(self, method)(*args)
+
+
+    def order_submissions(self, student_filenames):
+        if self.order == "name":
+            return sorted(student_filenames)
+        # 预计耗时最长的提交最先评测，以缩短批量评测末尾的长尾。没有历史耗时的提交按耗时中位数估计，再按压缩包大小排序。
+        history = {}
+        if self.order == "auto":
+            try:
+                with open(self.timing_history_path, "r") as hf:
+                    history = json.loads(hf.read())
+            except (OSError, JSONDecodeError):
+                pass
+        known = sorted(history[f] for f in student_filenames if f in history)
+        default_duration = known[len(known) // 2] if known else 0
+        def expected_cost(f):
+            try:
+                size = os.path.getsize(path.join(self.stu_files_folder, f))
+            except OSError:
+                size = 0
+            return (history.get(f, default_duration), size)
+        return sorted(student_filenames, key=expected_cost, reverse=True)
+
+
+    def save_timing_history(self):
+        history = {}
+        try:
+            with open(self.timing_history_path, "r") as hf:
+                history = json.loads(hf.read())
+        except (OSError, JSONDecodeError):
+            pass
+        history.update(self.durations)
+        with open(self.timing_history_path + ".tmp", "w") as hf:
+            hf.write(json.dumps(history, ensure_ascii=False))
+        os.replace(self.timing_history_path + ".tmp", self.timing_history_path)
+
+
+    def env_path(self, env_id):
+        # 超出内存预算的提交在grading_envs中的评测环境里评测。
+        return self.env_locations.get(env_id) or path.join(self.workspace_path, f"env{env_id}")
+
 
-    def free_env(self, env_id):
-        self.env_available[env_id].release()
+    def place_env(self, env_id, archive_path):
+        # 按压缩包中央目录中需要解压的文件的大小估计评测所需空间，超出每个评测环境的内存预算或内存文件系统的剩余空间时改用磁盘。
+        if not self.workspace_root:
+            return self.env_path(env_id)
+        max_member_size = self.config.extract_limits.max_member_size
+        try:
+            with zipfile.ZipFile(archive_path, "r") as zip_ref:
+                estimate = self.reference_size + sum(
+                    info.file_size for info in zip_ref.infolist()
+                    if self.member_wanted(info) and info.file_size <= max_member_size
+                )
+        except (OSError, zipfile.BadZipFile):
+            estimate = self.reference_size
+        # 评测环境已在内存中时，其中的干净评测环境会被复用或覆盖，不额外占用空间。
+        in_use = self.reference_size if path.exists(path.join(self.workspace_path, f"env{env_id}")) else 0
+        if (self.slot_memory and estimate > self.slot_memory) or estimate > shutil.disk_usage(self.workspace_root).free + in_use:
+            if env_id not in self.env_locations:
+                logger.debug(f"提交{path.basename(archive_path)}预计需要{estimate}字节，超出内存预算，评测环境{env_id}改用磁盘。")
+            self.env_locations[env_id] = path.join(self.grading_env_path, f"env{env_id}")
+        else:
+            self.env_locations.pop(env_id, None)
+        os.makedirs(self.env_path(env_id), exist_ok=True)
+        return self.env_path(env_id)
+
+
+    def cleanup_workspace(self):
+        for env_dir in os.listdir(self.workspace_root):
+            if re.match(r"^env[0-9]+$", env_dir):
+                shutil.rmtree(path.join(self.workspace_root, env_dir), ignore_errors=True)
+        logger.debug(f"已清理{self.workspace_root}中的评测环境。")
+
+
+    def prepare_stu_dir(self, env_id):
+        env_path = self.env_path(env_id)
+        env_stu_path = path.join(env_path, f"stu")
+        if path.exists(env_stu_path):
+            shutil.rmtree(env_stu_path)
+        os.makedirs(env_stu_path)
+
+
+    def prepare_env(self, env_id):
+        env_path = self.env_path(env_id)
+        env_judge_path = path.join(env_path, f"clean_xv6")
 
+        if self.workspace_mode == "copy" or not path.exists(env_judge_path):
+            if path.exists(env_judge_path):
+                shutil.rmtree(env_judge_path)
+            self.populate_env(env_judge_path)
+            return
+        
+        if self.workspace_mode == "git":
+            try:
+                subprocess.check_call(["git", "checkout", "-q", "-f", "HEAD", "--", "."], cwd=env_judge_path, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                subprocess.check_call(["git", "clean", "-q", "-f", "-d"], cwd=env_judge_path, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            except subprocess.CalledProcessError:
+                logger.warning(f"无法通过git还原评测环境{env_id}，将重新构造。")
+                shutil.rmtree(env_judge_path)
+                self.populate_env(env_judge_path)
+                return
+            # git clean不会删除被忽略的编译产物，仍需与干净评测环境比较。
+            restored, removed = self.sync_env(env_judge_path, self.clean_tracked_files)
+        else:
+            restored, removed = self.sync_env(env_judge_path, set())
+        logger.verbose(f"已还原评测环境{env_id}中的{restored}个文件，删除{removed}个干净评测环境中不存在的文件。")
+
+
+    def sync_env(self, env_judge_path, skipped):
+        # 还原大小或修改时间与干净评测环境不同的文件，并删除上一份提交留下的编译产物等多余文件，
+        # 避免缺少源文件的提交沿用此前提交的编译结果。skipped中的文件已由其他方式还原。
+        restored = removed = 0
+        seen = set()
+        for dir_path, dir_names, file_names in os.walk(env_judge_path):
+            rel_dir = path.relpath(dir_path, env_judge_path)
+            for dir_name in list(dir_names):
+                rel_path = path.normpath(path.join(rel_dir, dir_name))
+                if rel_path == ".git":
+                    dir_names.remove(dir_name)
+                elif path.islink(path.join(dir_path, dir_name)):
+                    # 指向文件夹的符号链接按文件处理。
+                    dir_names.remove(dir_name)
+                    file_names.append(dir_name)
+                elif rel_path not in self.clean_dirs:
+                    dir_names.remove(dir_name)
+                    shutil.rmtree(path.join(dir_path, dir_name))
+                    removed += 1
+            for file_name in file_names:
+                rel_path = path.normpath(path.join(rel_dir, file_name))
+                env_file = path.join(dir_path, file_name)
+                seen.add(rel_path)
+                if rel_path in skipped:
+                    continue
+                if rel_path not in self.clean_files:
+                    self.detach(env_file)
+                    removed += 1
+                    continue
+                stat = os.lstat(env_file)
+                if (stat.st_size, stat.st_mtime_ns) != self.clean_files[rel_path]:
+                    self.detach(env_file)
+                    shutil.copy2(path.join(self.clean_xv6_path, rel_path), env_file, follow_symlinks=False)
+                    restored += 1
+        for rel_path in self.clean_files.keys() - seen - skipped:
+            env_file = path.join(env_judge_path, rel_path)
+            os.makedirs(path.dirname(env_file), exist_ok=True)
+            shutil.copy2(path.join(self.clean_xv6_path, rel_path), env_file, follow_symlinks=False)
+            restored += 1
+        return restored, removed
+
+
+    def populate_env(self, env_judge_path):
+        with open(path.join(path.dirname(env_judge_path), "reference_stamp"), "w") as sf:
+            sf.write(self.reference_stamp)
+        if self.populate_mode != "hardlink":
+            shutil.copytree(self.clean_xv6_path, env_judge_path, symlinks=True)
+            return
         
+        # 只有git跟踪的源文件与git对象是只读的，可以安全地硬链接；编译产物等其他文件仍需复制。
+        def link_or_copy(src, dst):
+            rel_path = path.relpath(src, self.clean_xv6_path)
+            if rel_path in self.clean_tracked_files or rel_path.startswith(path.join(".git", "objects")):
+                try:
+                    os.link(src, dst)
+                    return dst
+                except OSError:
+                    pass
+            return shutil.copy2(src, dst)
+        shutil.copytree(self.clean_xv6_path, env_judge_path, symlinks=True, copy_function=link_or_copy)
+
+
+    def detach(self, file_path):
+        # 写入前先删除原文件，避免通过硬链接改写到干净的评测环境。
+        try:
+            os.remove(file_path)
+        except OSError:
+            pass
+
+        
+    def parse_student_file(self, student_file):
+        parse_regex = r"^([a-zA-Z0-9]{5,12})_([\w\u4e00-\u9fa5]{2,20})_file\.zip$"
+        match_res = re.match(parse_regex, student_file)
+        return match_res.groups() if match_res else None
+
+
+    def log_path(self, student_file):
+        return path.join(self.config.script_output, f"{student_file}_outputlog.txt" + (".gz" if self.log_gzip else ""))
+
+
     def single_grade(self, env_id, student_file):
-        env_path = path.join(self.grading_env_path, f"env{env_id}")
-        env_judge_path = path.join(env_path, f"clean_xv6")
-        env_stu_path = path.join(env_path, f"stu")
         orig_stu_path = path.join(self.stu_files_folder, student_file)
+        timer = self.env_timers.get(env_id) or PhaseTimer()
         score = 0
         
-        parse_regex = r"^([a-zA-Z0-9]{5,12})_([\w\u4e00-\u9fa5]{2,20})_file\.zip$"
-        match_res = re.match(parse_regex, student_file)
+        match_res = self.parse_student_file(student_file)
 
         name = None
         stu_id = None
@@ -235,50 +1246,130 @@ class Grader:
 
         if not match_res:
             logger.warning(f"检测到不符合命名规则的文件{student_file}。")
-            self.result_mutex.acquire()
-            self.bad_files.append(student_file)
-            self.result_mutex.release()
-            self.free_env(env_id)
-            self.semaphore.release()
+            self.report("record_result", student_file, None, [])
+            timer.outcome = "bad_name"
             return
         else:
-            name = match_res.groups()[1]
-            stu_id = match_res.groups()[0]
+            stu_id, name = match_res
             logger.debug(f"评测环境{env_id}开始对{name}（{stu_id}）的提交文件执行测试。")
 
-        logger.verbose(f"正在初始化并行评测环境{env_id}……")
-        if path.exists(env_path):
-            shutil.rmtree(env_path)
-        os.mkdir(env_path)
-        shutil.copytree(self.clean_xv6_path, env_judge_path)
-        
+        env_path = self.place_env(env_id, orig_stu_path)
+        env_judge_path = path.join(env_path, f"clean_xv6")
+        env_stu_path = path.join(env_path, f"stu")
+        self.prepare_stu_dir(env_id)
         logger.verbose(f"正在将{orig_stu_path}解压至{env_stu_path}")
+        stu_index = SubmissionIndex(env_stu_path)
         try:
             with zipfile.ZipFile(orig_stu_path, 'r') as zip_ref:
-                zip_ref.extractall(env_stu_path)
-            
-            compressed_files = glob.glob(env_stu_path + "/**/*.zip", recursive=True) + glob.glob(env_stu_path + "/**/*.rar", recursive=True)
-            while compressed_files:
-                logger.debug(f"在{name}（{stu_id}）的提交文件中发现嵌套压缩包{[path.basename(f) for f in compressed_files]}。正在重新解压。")
-                for cf in compressed_files:
-                    if cf.endswith(".zip"):
-                        with zipfile.ZipFile(cf, 'r') as zip_ref:
-                            zip_ref.extractall(env_stu_path)
-                    elif cf.endswith(".rar"):
-                        subprocess.check_call(["unrar", "x", cf, env_stu_path], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-                    os.remove(cf)
-                compressed_files = glob.glob(env_stu_path + "/**/*.zip", recursive=True) + glob.glob(env_stu_path + "/**/*.rar", recursive=True)
+                self.extract_zip(zip_ref, env_stu_path, stu_index, DotDict(entries=0, size=0), 0)
         except Exception as e:
             logger.error(f"无法完成对{name}（{stu_id}）的提交文件的解压。失败原因：{e}")
             err_msg.append(f"无法解压，因为'{e}'")
+        timer.lap("extract")
         
-        logger.verbose(f"正在将需要查重的学生文件重命名并复制至查重文件夹……")
-
-        for file in self.config.plagiarism_test:
-            self.find_copy(file, env_stu_path, path.join(self.moss_path, file, f"{stu_id}_{name}_{file}"))
+        log_path = self.log_path(student_file)
+        cache_key = None
+        if self.result_cache:
+            cache_key = self.result_cache_key(stu_index, stu_id, name)
+            cached = self.wait_cached_result(cache_key)
+            if not cached:
+                self.env_cache_keys[env_id] = cache_key
+            if cached:
+                score = cached["score"]
+                err_msg += cached["err_msg"]
+                logger.info(f"{name}（{stu_id}）的提交与已评测的提交相同，沿用结果{score}分。")
+                self.copy_cached_log(cache_key, log_path)
+                timer.lap("cache")
+                self.report("record_result", student_file, score, err_msg)
+                timer.outcome = "cached"
+                return
+            timer.lap("cache")
+        keyed_msg_count = len(err_msg)
+        
+        logger.verbose(f"正在初始化并行评测环境{env_id}……")
+        self.prepare_env(env_id)
+        timer.lap("prepare")
         
         logger.verbose(f"正在构造评测环境……")
 
+        missing_files = self.stage_files(env_judge_path, stu_index, stu_id, name, err_msg)
+
+        if missing_files:
+            logger.warning(f"{name}（{stu_id}）的提交中缺少下列文件：{missing_files}")
+            err_msg.append(f"缺少文件：{missing_files}")
+        timer.lap("stage")
+        
+        self.apply_overrides(env_id, env_judge_path, stu_id, name, err_msg)
+        timer.lap("overrides")
+        log_sink = LogSink(log_path, self.log_gzip, self.log_max_size)
+
+        if self.config.preflight:
+            preflight_errors, preflight_timed_out = self.run_preflight(env_id, env_judge_path, missing_files, log_sink)
+            timer.lap("preflight")
+            if preflight_errors:
+                # 得分已经确定，无需运行评测脚本。
+                log_sink.close()
+                logger.error(f"{name}（{stu_id}）的提交未通过编译检查，0分。")
+                err_msg += preflight_errors
+                if cache_key and not preflight_timed_out:
+                    self.store_cached_result(cache_key, 0, err_msg[keyed_msg_count:], log_path)
+                    self.release_cache_key(cache_key)
+                    self.env_cache_keys.pop(env_id, None)
+                self.report("record_result", student_file, 0, err_msg)
+                timer.outcome = "preflight"
+                return
+
+        logger.debug(f"评测环境{env_id}构造完成，开始评测。")
+        limit_msg = None
+        if self.config.test_cases:
+            score, found, case_msgs, cache_hits, cache_misses = self.run_test_cases(env_id, stu_index, stu_id, name, log_sink)
+            timer.lap("test")
+            err_msg += case_msgs
+        else:
+            stats_log = path.join(env_path, "ccache_stats.log")
+            groups, limit_msg, build_done = self.run_test_script(env_judge_path, self.build_env(env_judge_path, stats_log), log_sink, f"{name}（{stu_id}）")
+            score = groups[0] if groups else None
+            found = score is not None
+            # 评测脚本同时负责编译与测试，配置了build_done_regex时以其首次匹配的时刻划分两个阶段。
+            if build_done:
+                timer.lap("build", build_done)
+            timer.lap("test")
+            if self.build_cache:
+                cache_hits, cache_misses = self.read_build_cache_stats(stats_log)
+        if self.build_cache:
+            logger.debug(f"{name}（{stu_id}）的提交编译缓存命中{cache_hits}次，未命中{cache_misses}次。")
+            log_sink.write(f"\n===== build cache: {cache_hits} hits, {cache_misses} misses =====\n".encode())
+        log_sink.close()
+
+        if limit_msg:
+            logger.error(f"在运行{name}（{stu_id}）的提交时，{limit_msg}，已终止评测脚本，0分。")
+            err_msg.append(limit_msg)
+            score = 0
+            found = False
+        elif not found and self.config.test_cases:
+            # 各测试的得分单独计算，部分测试未能完成时仍保留其他测试的得分。
+            logger.error(f"{name}（{stu_id}）的提交有测试未能完成，{score}分。")
+        elif not found:
+            logger.error(f"在运行{name}（{stu_id}）的提交时，评测脚本执行失败，0分。")
+            err_msg.append(f"评测脚本执行失败")
+            score = 0
+        else:
+            logger.info(f"{name}（{stu_id}）的提交评测完成，{score}分。")
+            err_msg.append(f"评测脚本执行成功")
+
+        if cache_key:
+            if found:
+                self.store_cached_result(cache_key, score, err_msg[keyed_msg_count:], log_path)
+            self.release_cache_key(cache_key)
+            self.env_cache_keys.pop(env_id, None)
+
+        if self.build_cache:
+            self.report("record_build_cache_stats", student_file, cache_hits, cache_misses)
+        self.report("record_result", student_file, score, err_msg)
+        return
+    
+
+    def stage_files(self, env_judge_path, stu_index, stu_id, name, err_msg):
         logger.verbose(f"正在复制需要学生新建的文件……")
         missing_files = []
         for file_name, dst in self.config.new_file.items():
@@ -287,7 +1378,7 @@ class Grader:
             except OSError:
                 pass
             
-            find_count = self.find_copy(file_name, env_stu_path, path.join(env_judge_path, dst))
+            find_count = self.find_copy(file_name, stu_index, path.join(env_judge_path, dst))
             if find_count == 0:
                 logger.debug(f"未在{name}（{stu_id}）的提交中找到需要新建的源文件{file_name}。")
                 missing_files.append(file_name)
@@ -297,18 +1388,17 @@ class Grader:
         
         logger.verbose(f"正在替换需要学生更改的文件……")
         for file_name, dst in self.config.alter_file.items():
-            find_count = self.find_copy(file_name, env_stu_path, path.join(env_judge_path, dst))
+            find_count = self.find_copy(file_name, stu_index, path.join(env_judge_path, dst))
             if find_count == 0:
                 logger.debug(f"未在{name}（{stu_id}）的提交中找到需要替换的源文件{file_name}。将使用评测环境中的源文件代替。")
                 missing_files.append(file_name)
             elif find_count != 1:
                 logger.debug(f"在{name}（{stu_id}）的提交中发现多个{file_name}，任选其一。")
                 err_msg.append(f"发现多个{file_name}")
-        
-        if missing_files:
-            logger.warning(f"{name}（{stu_id}）的提交中缺少下列文件：{missing_files}")
-            err_msg.append(f"缺少文件：{missing_files}")
-        
+        return missing_files
+
+
+    def apply_overrides(self, env_id, env_judge_path, stu_id, name, err_msg):
         logger.verbose(f"正在根据配置最终覆写评测环境……")
         for override_item in self.config.overrides:
             to_override = path.join(env_judge_path, override_item.file_path)
@@ -323,6 +1413,7 @@ class Grader:
                         logger.error(f"在替换{override_item.file_path}时，未能找到应替换的字串{original_expanded}")
                         raise
                     replaced_txt = replaced_txt.replace(original_expanded, altered_expanded)
+                    self.detach(to_override)
                     with open(to_override, "w") as wf:
                         wf.write(replaced_txt)
                 except Exception as e:
@@ -333,68 +1424,441 @@ class Grader:
                 to_create = path.join(env_judge_path, override_item.file_path)
                 try:
                     content_expanded = override_item.operation.content.format(env_id=env_id, stu_id=stu_id, name=name)
+                    self.detach(to_create)
                     with open(to_create, "w") as wf:
                         wf.write(content_expanded)
                 except Exception as e:
                     logger.error(f"生成{to_create}时出现错误：{e}。")
                     err_msg.append(f"生成{to_create}时出现错误")
                 logger.verbose(f"完成对{to_create}的生成。")
-            
-        logger.debug(f"评测环境{env_id}构造完成，开始评测。")
-        
-        p = subprocess.run([path.join(env_judge_path, self.config.test_script)], cwd=env_judge_path, capture_output=True)
-
-        score_out = [line.decode('utf-8') for line in p.stdout.split(b'\n')]
-        found = False
-        for line in score_out:
-            score_match_res = re.match(self.config.result_regex, line)
-            if score_match_res:
-                score = score_match_res.groups()[0]
-                found = True
+
+
+    def run_test_cases(self, env_id, stu_index, stu_id, name, log_sink):
+        # 将评测拆分为互相独立的测试，在本评测环境与其他空闲的评测环境中并行运行，再汇总各测试的得分。
+        # 借用的评测环境按自身的编号重新复制学生文件并覆写，使QEMU、GDB端口等互不冲突。
+        cases = queue.Queue()
+        for case in self.config.test_cases:
+            cases.put(case)
+        outcomes = {}
+        log_lock = Lock()
+        helpers = []
+
+        def run_case(slot_id, case):
+            try:
+                outcomes[case.name] = self.run_test_case(slot_id, case, stu_id, name, log_sink, log_lock)
+            except Exception as e:
+                logger.error(f"在评测环境{slot_id}中运行{name}（{stu_id}）的测试{case.name}时出现错误：{e}")
+
+        def run_borrowed(slot_id):
+            try:
+                # 被借用的评测环境与本评测环境位于同一位置（内存或磁盘）。
+                if env_id in self.env_locations:
+                    self.env_locations[slot_id] = path.join(self.grading_env_path, f"env{slot_id}")
+                else:
+                    self.env_locations.pop(slot_id, None)
+                slot_judge_path = path.join(self.env_path(slot_id), "clean_xv6")
+                logger.verbose(f"借用评测环境{slot_id}评测{name}（{stu_id}）的提交。")
+                # 被借用的评测环境可能尚未被使用过。
+                os.makedirs(path.dirname(slot_judge_path), exist_ok=True)
+                self.prepare_env(slot_id)
+                self.stage_files(slot_judge_path, stu_index, stu_id, name, [])
+                self.apply_overrides(slot_id, slot_judge_path, stu_id, name, [])
+                while True:
+                    try:
+                        case = cases.get_nowait()
+                    except queue.Empty:
+                        return
+                    run_case(slot_id, case)
+            except Exception as e:
+                logger.error(f"借用评测环境{slot_id}时出现错误：{e}")
+            finally:
+                self.env_available[slot_id].release()
+
+        def borrow_idle_slots():
+            # 子进程之间不共享评测环境的锁，只能在本评测环境中依次运行各测试。
+            if self.use_processes:
+                return
+            for slot_id in range(self.parallel_count):
+                if cases.qsize() <= 1:
+                    return
+                if slot_id == env_id or not self.env_available[slot_id].acquire(blocking=False):
+                    continue
+                helper = Thread(target=run_borrowed, args=(slot_id,))
+                helpers.append(helper)
+                helper.start()
+
+        # 每运行一个测试前都尝试借用空闲的评测环境，使批量评测末尾空闲下来的评测环境也能参与。
+        while True:
+            borrow_idle_slots()
+            try:
+                case = cases.get_nowait()
+            except queue.Empty:
                 break
+            run_case(env_id, case)
+        for helper in helpers:
+            helper.join()
 
-        self.output_mutex.acquire()
+        score, possible, found, scored = 0, 0, True, 0
+        hits, misses = 0, 0
+        breakdown, messages = [], []
+        for case in self.config.test_cases:
+            outcome = outcomes.get(case.name)
+            if outcome:
+                hits += outcome.hits
+                misses += outcome.misses
+            if not outcome or not outcome.groups or outcome.limit_msg:
+                found = False
+                messages.append(f"测试{case.name}{outcome.limit_msg if outcome and outcome.limit_msg else '执行失败'}")
+                breakdown.append(f"{case.name} 0")
+                continue
+            score += float(outcome.groups[0])
+            scored += 1
+            if len(outcome.groups) > 1 and outcome.groups[1]:
+                possible += float(outcome.groups[1])
+                breakdown.append(f"{case.name} {outcome.groups[0]}/{outcome.groups[1]}")
+            else:
+                breakdown.append(f"{case.name} {outcome.groups[0]}")
+        messages.append(f"分项得分：{'，'.join(breakdown)}")
+        # 没有任何测试得出得分时与评测脚本执行失败相同，记为整数0，使该提交出现在执行失败列表中。
+        if not scored:
+            return 0, found, messages, hits, misses
+        return f"{score:g}", found, messages, hits, misses
+
+
+    def run_test_case(self, slot_id, case, stu_id, name, log_sink, log_lock):
+        env_path = self.env_path(slot_id)
+        env_judge_path = path.join(env_path, "clean_xv6")
+        stats_log = path.join(env_path, "ccache_stats.log")
+        case_log_path = path.join(env_path, "case_output.log")
+        case_sink = LogSink(case_log_path, False, self.log_max_size)
+        command = [arg.format(env_id=slot_id, stu_id=stu_id, name=name) for arg in case.command]
+        groups, limit_msg, _ = self.run_test_script(env_judge_path, self.build_env(env_judge_path, stats_log), case_sink,
+                                                    f"{name}（{stu_id}）[{case.name}]", command, self.config.case_regex)
+        case_sink.close()
+        hits, misses = self.read_build_cache_stats(stats_log) if self.build_cache else (0, 0)
+        # 各测试的输出完整地依次写入该提交的日志，不互相穿插。
+        with log_lock, open(case_log_path, "rb") as case_log:
+            log_sink.write(f"\n===== test case {case.name} (env {slot_id}) =====\n".encode())
+            for chunk in iter(lambda: case_log.read(65536), b""):
+                log_sink.write(chunk)
+        os.remove(case_log_path)
+        if limit_msg:
+            logger.warning(f"{name}（{stu_id}）的测试{case.name}{limit_msg}，已终止。")
+        return DotDict(groups=groups, limit_msg=limit_msg, hits=hits, misses=misses)
+
+
+    def run_preflight(self, env_id, env_judge_path, missing_files, log_sink):
+        # 在完整评测前快速检查学生文件能否编译。返回导致0分的原因（为空时继续评测）与是否有编译检查超时。
+        # 超时可能由机器负载导致，此时的结果不应缓存。
+        preflight = self.config.preflight
+        reasons = [f"缺少必需的文件{file_name}" for file_name in preflight.required if file_name in missing_files]
+        timed_out = False
+        if not preflight.command:
+            return reasons, timed_out
+        for file_name in preflight.files:
+            if file_name in missing_files:
+                continue
+            dst = self.config.new_file.get(file_name) or self.config.alter_file.get(file_name)
+            command = [arg.format(file=dst, env_id=env_id) for arg in preflight.command]
+            try:
+                result = subprocess.run(command, cwd=env_judge_path, env=self.build_env(env_judge_path),
+                                        stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=preflight.timeout)
+            except subprocess.TimeoutExpired:
+                reasons.append(f"{file_name}编译检查超时")
+                timed_out = True
+                continue
+            except OSError as e:
+                # 编译检查本身无法运行时不影响学生得分。
+                logger.error(f"无法运行编译检查{command}：{e}")
+                return reasons, timed_out
+            if result.returncode == 0:
+                continue
+            log_sink.write(f"===== preflight: {' '.join(command)} =====\n".encode() + result.stdout + b"\n")
+            output = result.stdout.decode("utf-8", errors="replace").splitlines()
+            first_error = next((line for line in output if "error" in line), output[0] if output else "")
+            reasons.append(f"{file_name}编译错误：{first_error.strip()[:200]}")
+        return reasons, timed_out
+
+
+    def run_test_script(self, env_judge_path, env, log_sink, echo_prefix, command=None, score_regex=None):
+        # 评测脚本在独立的进程组中运行，超出限制时连同QEMU等子进程一并终止。
+        # stdout与stderr由两个线程逐行读取并写入日志，得分在读取stdout时逐行匹配，输出不在内存中积累。
+        # CPU时间与内存限制不使用preexec_fn设置（在多线程进程中fork后执行Python代码可能死锁），
+        # 而是经由prlimit命令在评测脚本启动前设置；没有prlimit命令时在启动后立即设置。
+        limits = self.config.limits
+        rlimits = []
+        if limits.cpu_time:
+            rlimits.append((resource.RLIMIT_CPU, "--cpu", limits.cpu_time))
+        if limits.memory:
+            rlimits.append((resource.RLIMIT_AS, "--as", limits.memory))
+        command = command or [path.join(env_judge_path, self.config.test_script)]
+        prlimit_path = shutil.which("prlimit") if rlimits else None
+        if prlimit_path:
+            command = [prlimit_path] + [f"{option}={value}" for _, option, value in rlimits] + ["--"] + command
+
+        score_regex = score_regex or self.config.result_regex
+        state = DotDict(score=None, build_done=None, output_size=0, size_lock=Lock())
+        echo = logger.isEnabledFor(logging.DEBUG)
+        def pump(stream, prefix, match_score):
+            # 单行长度有上限，避免不换行的输出占满内存。
+            for line in iter(lambda: stream.readline(65536), b""):
+                with state.size_lock:
+                    state.output_size += len(line)
+                log_sink.write(prefix + line)
+                if match_score and self.config.build_done_regex and state.build_done is None \
+                        and re.match(self.config.build_done_regex, line.decode("utf-8", errors="replace").rstrip("\n")):
+                    state.build_done = time.monotonic()
+                if match_score and state.score is None:
+                    score_match_res = re.match(score_regex, line.decode("utf-8", errors="replace").rstrip("\n"))
+                    if score_match_res:
+                        state.score = score_match_res.groups()
+                if echo:
+                    logger.verbose(f"{echo_prefix}{prefix.decode()}\t{line.decode('utf-8', errors='replace').rstrip()}")
+            stream.close()
+
+        limit_msg = None
+        start_time = time.monotonic()
+        proc = subprocess.Popen(command, cwd=env_judge_path, env=env,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE, start_new_session=True)
+        if rlimits and not prlimit_path:
+            for resource_id, _, value in rlimits:
+                try:
+                    resource.prlimit(proc.pid, resource_id, (value, value))
+                except (ProcessLookupError, PermissionError):
+                    pass
+        pumps = [Thread(target=pump, args=(proc.stdout, b"", True)), Thread(target=pump, args=(proc.stderr, b"[stderr] ", False))]
+        for pump_thread in pumps:
+            pump_thread.start()
+        while True:
+            try:
+                proc.wait(timeout=0.5)
+                break
+            except subprocess.TimeoutExpired:
+                pass
+            if limits.wall_time and time.monotonic() - start_time > limits.wall_time:
+                limit_msg = f"评测超时（{limits.wall_time}秒）"
+            elif limits.output_size and state.output_size > limits.output_size:
+                limit_msg = f"评测脚本输出超过{limits.output_size}字节"
+            if limit_msg:
+                break
+        # 评测脚本退出后，也要清理其遗留在进程组中的子进程。
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        proc.wait()
+        # 脱离进程组的子进程可能仍持有管道，此时不再等待其输出。
+        for pump_thread in pumps:
+            pump_thread.join(timeout=5)
+        if not limit_msg and limits.output_size and state.output_size > limits.output_size:
+            limit_msg = f"评测脚本输出超过{limits.output_size}字节"
+        return state.score, limit_msg, state.build_done
+
+
+    def result_cache_key(self, stu_index, stu_id, name):
+        # 评测结果只取决于评测用到的学生文件、配置文件、评测仓库版本与评测脚本本身。
+        key = hashlib.sha256()
+        for hashed_file in [self.config_file, os.path.realpath(__file__)]:
+            with open(hashed_file, "rb") as hf:
+                key.update(hashlib.sha256(hf.read()).digest())
+        key.update(self.clean_commit.encode())
+        key.update(json.dumps(self.config.limits, sort_keys=True).encode())
+        for file_name in list(self.config.new_file) + list(self.config.alter_file):
+            matches = stu_index.lookup(file_name)
+            key.update(f"{file_name}:{len(matches)}:".encode())
+            if matches:
+                with open(matches[0], "rb") as sf:
+                    key.update(hashlib.sha256(sf.read()).digest())
+        # 覆写内容与学生身份有关时，相同的提交也不能共享结果。
+        for override in self.config.overrides:
+            if any("{stu_id}" in v or "{name}" in v for v in override.operation.values() if isinstance(v, str)):
+                key.update(f"{stu_id}_{name}".encode())
+                break
+        return key.hexdigest()
 
-        if not found:
-            logger.error(f"在运行{name}（{stu_id}）的提交时，评测脚本执行失败，0分。")
-            err_msg.append(f"评测脚本执行失败")
-        else:
-            logger.info(f"{name}（{stu_id}）的提交评测完成，{score}分。")
-            err_msg.append(f"评测脚本执行成功")
-        
-        logger.verbose(f"评测脚本输出（stdout）：")
-        for line in p.stdout.split(b'\n'):
-            logger.verbose(f"\t{line}")
-        logger.verbose(f"评测脚本输出（stderr）：")
-        for line in p.stderr.split(b'\n'):
-            logger.verbose(f"\t{line}")
-        
-        with open(path.join(self.config.script_output, f"{student_file}_outputlog.txt"), "w") as log_file:
-            log_file.write("\n===== stdout =====\n")
-            log_file.write(p.stdout.decode(self.codex))
-            log_file.write("\n===== stderr =====\n")
-            log_file.write(p.stderr.decode(self.codex))
 
-        self.output_mutex.release()
+    def result_cache_file(self, cache_key, suffix):
+        return path.join(self.result_cache_path, cache_key[:2], cache_key + suffix)
 
+
+    def wait_cached_result(self, cache_key):
+        # 相同的提交正在其他评测环境中评测时，等待其完成后直接沿用结果。
+        while True:
+            self.result_mutex.acquire()
+            if not self.regrade or cache_key in self.result_cache_fresh:
+                try:
+                    with open(self.result_cache_file(cache_key, ".json"), "r") as cf:
+                        cached = json.loads(cf.read())
+                    self.result_mutex.release()
+                    return cached
+                except (OSError, JSONDecodeError):
+                    pass
+            inflight = self.result_cache_inflight.get(cache_key)
+            if not inflight:
+                self.result_cache_inflight[cache_key] = Event()
+                self.result_mutex.release()
+                return None
+            self.result_mutex.release()
+            inflight.wait()
+
+
+    def store_cached_result(self, cache_key, score, err_msg, log_path):
+        json_path = self.result_cache_file(cache_key, ".json")
+        os.makedirs(path.dirname(json_path), exist_ok=True)
+        shutil.copy(log_path, self.result_cache_file(cache_key, ".log.gz" if log_path.endswith(".gz") else ".log"))
+        with open(json_path + ".tmp", "w") as cf:
+            cf.write(json.dumps({"score": score, "err_msg": err_msg}, ensure_ascii=False))
+        os.replace(json_path + ".tmp", json_path)
         self.result_mutex.acquire()
-        self.results[student_file] = (score, ";".join(err_msg))
-        if score == 0:
-            self.bad_files.append(student_file)
+        self.result_cache_fresh.add(cache_key)
         self.result_mutex.release()
-        self.free_env(env_id)
-        self.semaphore.release()
-        return
-    
 
-    def find_copy(self, file_name, src_dir, dst_path):
-        matches = glob.glob(src_dir+"/**/"+file_name, recursive=True)
+
+    def copy_cached_log(self, cache_key, log_path):
+        # 缓存的日志与本次要求的压缩方式不同时，转换后再复制。
+        for suffix in [".log.gz", ".log"] if log_path.endswith(".gz") else [".log", ".log.gz"]:
+            cached_log = self.result_cache_file(cache_key, suffix)
+            if not path.exists(cached_log):
+                continue
+            if suffix.endswith(".gz") == log_path.endswith(".gz"):
+                shutil.copy(cached_log, log_path)
+            else:
+                with (gzip.open if suffix.endswith(".gz") else open)(cached_log, "rb") as src, \
+                     (gzip.open if log_path.endswith(".gz") else open)(log_path, "wb") as dst:
+                    shutil.copyfileobj(src, dst)
+            return
+
+
+    def release_cache_key(self, cache_key):
+        self.result_mutex.acquire()
+        inflight = self.result_cache_inflight.pop(cache_key, None)
+        self.result_mutex.release()
+        if inflight:
+            inflight.set()
+
+
+    def extract_zip(self, zip_ref, dest, stu_index, budget, depth):
+        # 只读取压缩包的中央目录，仅解压配置中需要的文件；嵌套的zip压缩包直接在内存中展开。
+        limits = self.config.extract_limits
+        infos = zip_ref.infolist()
+        budget.entries += len(infos)
+        if budget.entries > limits.max_entries:
+            raise ValueError(f"压缩包内文件数量超过{limits.max_entries}")
+        
+        for info in infos:
+            if not self.member_wanted(info):
+                continue
+            file_name = info.filename.rstrip("/").split("/")[-1]
+            is_archive = file_name.endswith(".zip") or file_name.endswith(".rar")
+            if info.file_size > limits.max_member_size:
+                logger.warning(f"压缩包内的{info.filename}大小为{info.file_size}字节，超过限制，已跳过。")
+                continue
+            if is_archive and depth >= limits.max_depth:
+                logger.warning(f"压缩包{info.filename}的嵌套层数超过{limits.max_depth}，已跳过。")
+                continue
+            budget.size += info.file_size
+            if budget.size > limits.max_total_size:
+                raise ValueError(f"需要解压的文件总大小超过{limits.max_total_size}字节")
+            
+            if file_name in self.wanted_files:
+                stu_index.add(zip_ref.extract(info, dest))
+            elif file_name.endswith(".zip"):
+                logger.debug(f"发现嵌套压缩包{info.filename}，正在解压。")
+                with zipfile.ZipFile(io.BytesIO(zip_ref.read(info)), 'r') as nested_ref:
+                    self.extract_zip(nested_ref, self.member_path(dest, info.filename) + "_extracted", stu_index, budget, depth + 1)
+            else:
+                logger.debug(f"发现嵌套压缩包{info.filename}，正在解压。")
+                rar_path = zip_ref.extract(info, dest)
+                self.extract_rar(rar_path, rar_path + "_extracted", stu_index, budget, depth + 1)
+                os.remove(rar_path)
+
+
+    def member_wanted(self, info):
+        # 需要解压的文件：配置中需要的文件与嵌套的压缩包。
+        file_name = info.filename.rstrip("/").split("/")[-1]
+        return not info.is_dir() and (file_name in self.wanted_files or file_name.endswith(".zip") or file_name.endswith(".rar"))
+
+
+    def extract_rar(self, rar_path, dest, stu_index, budget, depth):
+        # 先用unrar lt列出各文件的大小，按与zip相同的规则检查限制，再只解压需要的文件与嵌套的压缩包。
+        limits = self.config.extract_limits
+        members = self.list_rar(rar_path)
+        budget.entries += len(members)
+        if budget.entries > limits.max_entries:
+            raise ValueError(f"压缩包内文件数量超过{limits.max_entries}")
+
+        selected = []
+        for member_name, size in members:
+            file_name = member_name.rstrip("/").split("/")[-1]
+            is_archive = file_name.endswith(".zip") or file_name.endswith(".rar")
+            if file_name not in self.wanted_files and not is_archive:
+                continue
+            if size > limits.max_member_size:
+                logger.warning(f"压缩包内的{member_name}大小为{size}字节，超过限制，已跳过。")
+                continue
+            if is_archive and depth >= limits.max_depth:
+                logger.warning(f"压缩包{member_name}的嵌套层数超过{limits.max_depth}，已跳过。")
+                continue
+            budget.size += size
+            if budget.size > limits.max_total_size:
+                raise ValueError(f"需要解压的文件总大小超过{limits.max_total_size}字节")
+            selected.append(member_name)
+        if not selected:
+            return
+
+        os.makedirs(dest, exist_ok=True)
+        subprocess.check_call(["unrar", "x", "-c-", "-p-", "-o+", "-y", rar_path] + selected + [dest + os.sep],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        for member_name in selected:
+            file_path = self.member_path(dest, member_name)
+            file_name = path.basename(file_path)
+            if not path.isfile(file_path):
+                continue
+            if file_name in self.wanted_files:
+                stu_index.add(file_path)
+            elif file_name.endswith(".zip"):
+                logger.debug(f"发现嵌套压缩包{member_name}，正在解压。")
+                with zipfile.ZipFile(file_path, 'r') as nested_ref:
+                    self.extract_zip(nested_ref, file_path + "_extracted", stu_index, budget, depth + 1)
+            else:
+                logger.debug(f"发现嵌套压缩包{member_name}，正在解压。")
+                self.extract_rar(file_path, file_path + "_extracted", stu_index, budget, depth + 1)
+
+
+    def list_rar(self, rar_path):
+        # 解析unrar lt的输出，返回[(文件名, 解压后大小)]，不包括文件夹。
+        output = subprocess.check_output(["unrar", "lt", "-c-", "-p-", rar_path], stderr=subprocess.DEVNULL)
+        members = []
+        entry = None
+        for line in output.decode("utf-8", errors="replace").splitlines():
+            key, sep, value = line.strip().partition(": ")
+            if not sep:
+                continue
+            if key == "Name":
+                entry = DotDict(name=value, type="File", size=0)
+                members.append(entry)
+            elif entry is not None and key == "Type":
+                entry.type = value
+            elif entry is not None and key == "Size":
+                entry.size = int(value) if value.isdigit() else 0
+        return [(entry.name, entry.size) for entry in members if entry.type == "File"]
+
+
+    def member_path(self, dest, member_name):
+        # 与zipfile.extract相同的路径清理规则，防止压缩包内的路径跳出解压目录。
+        parts = [p for p in member_name.replace("\\", "/").split("/") if p not in ("", ".", "..")]
+        return path.join(dest, *parts)
+
+
+    def find_copy(self, file_name, stu_index, dst_path):
+        matches = stu_index.lookup(file_name)
         if not matches:
             return 0
         
         if len(matches) != 1:
             logger.debug(f"发现多个{file_name}文件，选择{matches[0]}。")
 
+        self.detach(dst_path)
         shutil.copy(matches[0], dst_path)
         logger.verbose(f"将文件{matches[0]}拷贝至{dst_path}")
         return len(matches)
@@ -433,7 +1897,12 @@ class Grader:
         if not self.config.plagiarism_test:
             logger.debug("不进行代码查重检测。")
         else:
-            logger.debug(f"使用id{self.config.moss_userid}进行MOSS查重。")
+            if self.config.plagiarism_backend == "local":
+                logger.debug(f"使用本地查重，k={self.config.local_plagiarism.k}，窗口大小{self.config.local_plagiarism.window}。")
+                if self.corpus_path:
+                    logger.debug(f"使用指纹库{self.corpus_path}，本批次标签为{self.corpus_tag}。")
+            else:
+                logger.debug(f"使用id{self.config.moss_userid}进行MOSS查重。")
             for to_check, c_conf in self.config.plagiarism_test.items():
                 logger.debug(f"对文件{to_check}进行代码查重：")
                 if not c_conf.template:
@@ -450,7 +1919,30 @@ class Grader:
         logger.debug(f"评测仓库地址: {self.config.repo}")
         logger.debug(f"评测仓库分支: {self.config.branch}")
         logger.debug(f"单个评测脚本: {self.config.test_script}")
-        logger.debug(f"并行评测数量: {self.parallel_count}")
+        for limit_name, limit_desc in [("wall_time", "运行时间（秒）"), ("cpu_time", "单进程CPU时间（秒）"), ("memory", "单进程内存（字节）"), ("output_size", "输出大小（字节）")]:
+            if self.config.limits[limit_name]:
+                logger.debug(f"评测脚本{limit_desc}限制: {self.config.limits[limit_name]}")
+        logger.debug(f"并行评测数量: {self.parallel_count}（{'子进程' if self.use_processes else '线程'}）")
+        logger.debug(f"评测顺序: {self.order}")
+        if self.watch:
+            logger.debug(f"监视学生文件夹: 每{self.watch_interval}秒")
+        if self.serve:
+            logger.debug(f"协调者地址: {self.serve}")
+        logger.debug(f"评测环境复用: {self.workspace_mode}")
+        logger.debug(f"评测环境构造: {self.populate_mode}")
+        if self.workspace_root:
+            logger.debug(f"评测环境位置: {self.workspace_root}，每个评测环境的空间预算: {self.slot_memory or '不限'}")
+        logger.debug(f"编译缓存: {'启用' if self.build_cache else '禁用'}")
+        logger.debug(f"结果缓存: {'禁用' if not self.result_cache else ('重新评测' if self.regrade else '启用')}")
+        logger.debug(f"输出日志: {'gzip压缩' if self.log_gzip else '不压缩'}，{f'最多{self.log_max_size}字节' if self.log_max_size else '不限大小'}")
+        if self.config.prebuild:
+            logger.debug(f"预编译命令: {self.config.prebuild}")
+        if self.config.build_done_regex:
+            logger.debug(f"编译完成标志: {self.config.build_done_regex}")
+        if self.config.test_cases:
+            logger.debug(f"并行测试: {[case.name for case in self.config.test_cases]}，得分匹配: {self.config.case_regex}")
+        if self.config.preflight:
+            logger.debug(f"编译检查: {self.config.preflight.command}，检查{self.config.preflight.files}，必需{self.config.preflight.required}")
         logger.debug(f"待测文件位置: {self.stu_files_folder}")
         if self.config.overrides:
             logger.debug(f"覆写评测环境：")
@@ -469,7 +1961,7 @@ class Grader:
 
 if __name__ == "__main__":
     arg_parser = argparse.ArgumentParser(description="通用自动评测脚本。")
-    arg_parser.add_argument("config", type=str, help="自动评测脚本配置文件。")
+    arg_parser.add_argument("config", type=str, nargs="?", help="自动评测脚本配置文件。使用--worker时由协调者下发，无需指定。")
     arg_parser.add_argument("--parallel", "-p", type=int, default=1, help="并行任务数量。默认为1。")
     arg_parser.add_argument("--student-files", "-f", type=str, default="student_files", help="学生文件压缩包所在的文件夹。默认位于./student_files")
     arg_parser.add_argument('-v', '--verbose', action='count', default=0, help="输出等级。v越多，输出越多。支持-v -vv -vvv和空。")
@@ -477,6 +1969,27 @@ if __name__ == "__main__":
     arg_parser.add_argument("--codex", "-c", type=str, default="GB18030", help="输出.csv文件的编码。默认为GB18030。")
     arg_parser.add_argument("--plagiarism-threshold", "-t", type=int, default=90, help="抄袭判定阈值。默认为90。")
     arg_parser.add_argument("--anonymous", "-a", action="store_true", default=90, help="抄袭判定阈值。默认为90。")
+    arg_parser.add_argument("--workspace-mode", "-w", type=str, choices=["copy", "reset", "git"], default="copy", help="评测环境复用方式。copy为每份提交重新复制；reset还原与干净评测环境不同的文件并删除多余的编译产物；git使用git checkout与git clean还原源文件，其余同reset。默认为copy。")
+    arg_parser.add_argument("--populate", type=str, choices=["copy", "hardlink"], default="copy", help="首次构造评测环境的方式。hardlink会硬链接git跟踪的源文件。默认为copy。")
+    arg_parser.add_argument("--workspace-root", type=str, default=None, help="评测环境所在的文件夹，例如tmpfs中的/dev/shm/autograde。默认位于./grading_envs。程序退出时会删除其中的评测环境。")
+    arg_parser.add_argument("--slot-memory", type=int, default=0, help="使用--workspace-root时每个评测环境的空间预算（字节），预计超出的提交改在./grading_envs中评测。0表示仅受剩余空间限制。默认为0。")
+    arg_parser.add_argument("--build-cache", action="store_true", default=False, help="使用ccache在各评测环境之间共享编译缓存。")
+    arg_parser.add_argument("--no-result-cache", action="store_true", default=False, help="不使用评测结果缓存。")
+    arg_parser.add_argument("--regrade", action="store_true", default=False, help="忽略已缓存的评测结果，重新评测全部提交。")
+    arg_parser.add_argument("--resume", "-r", action="store_true", default=False, help="从评测输出文件夹中的评测日志继续上次中断的评测，跳过已完成的提交。")
+    arg_parser.add_argument("--order", type=str, choices=["auto", "size", "name"], default="auto", help="评测顺序。auto按历史评测耗时与压缩包大小从大到小；size按压缩包大小从大到小；name按文件名。默认为auto。")
+    arg_parser.add_argument("--processes", action="store_true", default=False, help="在子进程中执行评测，而非线程。")
+    arg_parser.add_argument("--watch", action="store_true", default=False, help="持续监视学生文件夹，评测新增或被修改的提交，并随时更新score.csv。按Ctrl+C停止。")
+    arg_parser.add_argument("--watch-interval", type=float, default=5, help="--watch检查学生文件夹的间隔（秒）。默认为5。")
+    arg_parser.add_argument("--serve", type=str, default=None, help="作为协调者在指定地址（host:port或unix:/path）上等待评测机连接，由评测机评测全部提交。省略host时只监听127.0.0.1，监听其他地址时需要指定--token。")
+    arg_parser.add_argument("--worker", type=str, default=None, help="作为评测机连接指定地址的协调者，使用--parallel个评测环境评测协调者分配的提交。")
+    arg_parser.add_argument("--state-dir", type=str, default=None, help="评测环境与各类缓存（grading_envs、reference_cache、build_cache、result_cache等）所在的文件夹。默认为grade.py所在目录。在同一目录中运行多个评测机时，需为每个评测机指定不同的文件夹。")
+    arg_parser.add_argument("--token", type=str, default=None, help="协调者与评测机之间的共享口令。")
+    arg_parser.add_argument("--timeout", type=int, default=None, help="单份提交评测脚本的最长运行时间（秒），覆盖配置文件中的limits.wall_time。0表示不限制。")
+    arg_parser.add_argument("--log-gzip", action="store_true", default=False, help="以gzip压缩评测脚本的输出日志。")
+    arg_parser.add_argument("--log-max-size", type=int, default=0, help="单份提交输出日志的最大字节数，超出部分被截断。0表示不限制。默认为0。")
+    arg_parser.add_argument("--corpus-tag", type=str, default=str(datetime.date.today().year), help="本批次提交在指纹库中的标签，同一标签的文件之间不通过指纹库比较。默认为当前年份。")
+    arg_parser.add_argument("--corpus-import", type=str, default=None, help="将指定的往届查重文件夹（结构与moss_path相同）导入指纹库后退出。")
     args = arg_parser.parse_args()
     
     logging.addLevelName(logging.DEBUG      , "细节")
@@ -502,10 +2015,43 @@ if __name__ == "__main__":
         ch.setLevel(logging.DEBUG)
     
     ch.setFormatter(CustomFormatter())
-    logger.addHandler(ch)
+    log_listener = QueueListener(log_queue, ch, respect_handler_level=True)
+    log_listener.start()
+    atexit.register(log_listener.stop)
+    logger.addHandler(queue_handler)
+
+    if args.worker:
+        def make_grader(config):
+            # 评测脚本输出发回协调者后即可丢弃，放在--state-dir中，使同一目录中的多个评测机互不干扰。
+            state_path = path.realpath(args.state_dir) if args.state_dir else path.dirname(os.path.realpath(__file__))
+            config["script_output"] = path.join(state_path, "worker_logs")
+            args.config = path.join(state_path, "grading_envs", "worker_config.json")
+            os.makedirs(path.dirname(args.config), exist_ok=True)
+            with open(args.config, "w") as cf:
+                cf.write(json.dumps(config, ensure_ascii=False))
+            return Grader(args)
+        run_worker(args.worker, args.parallel, args.token, make_grader)
+        exit(0)
+    if not args.config:
+        arg_parser.error("需要指定配置文件。")
+    if args.serve and not args.token and not is_local_address(args.serve):
+        # 评测机可以取得全部提交并写入成绩，监听其他机器可以访问的地址时必须验证口令。
+        arg_parser.error("--serve监听非本机地址时需要指定--token。")
 
     grader = Grader(args)
+    if args.corpus_import:
+        if not grader.corpus_path:
+            logger.fatal("配置文件中未指定fingerprint_corpus。")
+            exit(0)
+        grader.import_corpus(args.corpus_import)
+        exit(0)
     grader.setup_env()
+    if args.watch:
+        # 监视结束后再对全部提交查重。
+        grader.watch_grade()
+        grader.start_plagiarism()
+        grader.wait_plagiarism()
+        exit(0)
+    grader.start_plagiarism()
     grader.batch_grade()
-    grader.plagiarism_test()
-    grader.visualize_plagiarism()
+    grader.wait_plagiarism()
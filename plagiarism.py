@@ -0,0 +1,207 @@
+import re
+import json
+import sqlite3
+import hashlib
+
+# 本地代码查重：将C代码规范化为记号序列，对k-gram做winnowing取指纹，再通过倒排索引查找相似的文件对。
+
+C_KEYWORDS = {
+    "auto", "break", "case", "char", "const", "continue", "default", "do", "double", "else", "enum",
+    "extern", "float", "for", "goto", "if", "inline", "int", "long", "register", "restrict", "return",
+    "short", "signed", "sizeof", "static", "struct", "switch", "typedef", "union", "unsigned", "void",
+    "volatile", "while", "_Bool",
+}
+
+TOKEN_REGEX = re.compile(r"""
+      (?P<comment>//[^\n]*|/\*.*?\*/)
+    | (?P<preprocessor>^[ \t]*\#(?:\\\n|[^\n])*)
+    | (?P<string>"(?:\\.|[^"\\\n])*")
+    | (?P<char>'(?:\\.|[^'\\\n])*')
+    | (?P<number>\.?[0-9](?:[eEpP][+-]|[0-9a-zA-Z_.])*)
+    | (?P<identifier>[A-Za-z_][A-Za-z0-9_]*)
+    | (?P<operator>->|\+\+|--|<<=|>>=|<<|>>|<=|>=|==|!=|&&|\|\||[-+*/%&|^!=<>]=?|[][(){};,.?:~])
+""", re.VERBOSE | re.DOTALL | re.MULTILINE)
+
+
+def tokenize_c(source):
+    # 变量名、字面量统一替换为占位符，使改名、改常量等修改不影响指纹。注释与预处理指令被忽略。
+    tokens = []
+    for match in TOKEN_REGEX.finditer(source):
+        kind = match.lastgroup
+        if kind in ("comment", "preprocessor"):
+            continue
+        if kind == "identifier":
+            tokens.append(match.group() if match.group() in C_KEYWORDS else "I")
+        elif kind == "number":
+            tokens.append("N")
+        elif kind == "string":
+            tokens.append("S")
+        elif kind == "char":
+            tokens.append("C")
+        else:
+            tokens.append(match.group())
+    return tokens
+
+
+def kgram_hashes(tokens, k):
+    # 使用稳定的哈希函数，使指纹可以跨进程、跨学期保存与比较。
+    return [
+        int.from_bytes(hashlib.blake2b(" ".join(tokens[i:i + k]).encode(), digest_size=8).digest(), "big")
+        for i in range(len(tokens) - k + 1)
+    ]
+
+
+def winnow(hashes, window):
+    # 每个窗口中选取最小的哈希（相同时取最右侧），相邻窗口选中同一位置时只记录一次。
+    if len(hashes) <= window:
+        return {min(hashes)} if hashes else set()
+    fingerprints = set()
+    selected = -1
+    for start in range(len(hashes) - window + 1):
+        if selected < start:
+            selected = start
+            for i in range(start, start + window):
+                if hashes[i] <= hashes[selected]:
+                    selected = i
+        elif hashes[start + window - 1] <= hashes[selected]:
+            selected = start + window - 1
+        else:
+            continue
+        fingerprints.add(hashes[selected])
+    return fingerprints
+
+
+def fingerprint(source, k, window):
+    return winnow(kgram_hashes(tokenize_c(source), k), window)
+
+
+def posting_limit(max_doc_freq, doc_count, max_postings):
+    # 指纹最多出现在多少个文件中时仍参与比较。与MOSS的-m参数相同，max_postings为0时只按比例限制。
+    limit = max(2, int(max_doc_freq * doc_count))
+    return min(limit, max_postings) if max_postings else limit
+
+
+class LocalChecker:
+    # 倒排索引：指纹 -> 包含该指纹的文件。只需比较至少共享一个指纹的文件对，而非两两比较。
+    def __init__(self, k=10, window=6, max_doc_freq=0.5, base_sources=(), max_postings=100):
+        self.k = k
+        self.window = window
+        self.max_doc_freq = max_doc_freq
+        self.max_postings = max_postings
+        self.base = set()
+        for source in base_sources:
+            self.base |= fingerprint(source, k, window)
+        self.docs = {}
+        self.index = {}
+
+    def add(self, name, source):
+        fingerprints = fingerprint(source, self.k, self.window) - self.base
+        self.add_fingerprints(name, fingerprints)
+        return fingerprints
+
+    def add_fingerprints(self, name, fingerprints):
+        if name in self.docs:
+            for h in self.docs[name]:
+                self.index[h].discard(name)
+        self.docs[name] = fingerprints
+        for h in fingerprints:
+            self.index.setdefault(h, set()).add(name)
+
+    def matches(self, name):
+        # 返回与name共享指纹的文件及共享的指纹数量。出现在过多文件中的指纹（例如常见的代码框架）不参与比较。
+        max_postings = posting_limit(self.max_doc_freq, len(self.docs), self.max_postings)
+        shared = {}
+        for h in self.docs[name]:
+            postings = self.index[h]
+            if len(postings) > max_postings:
+                continue
+            for other in postings:
+                if other != name:
+                    shared[other] = shared.get(other, 0) + 1
+        return shared
+
+    def similar_pairs(self, threshold):
+        # 相似度为共享指纹数占各自指纹数的百分比，与MOSS报告中的百分比含义相同。
+        pairs = []
+        for name in sorted(self.docs):
+            for other, count in self.matches(name).items():
+                if other <= name:
+                    continue
+                percent = count * 100 // max(1, len(self.docs[name]))
+                other_percent = count * 100 // max(1, len(self.docs[other]))
+                if max(percent, other_percent) >= threshold:
+                    pairs.append((name, other, percent, other_percent, count))
+        pairs.sort(key=lambda pair: max(pair[2], pair[3]), reverse=True)
+        return pairs
+
+
+class FingerprintCorpus:
+    # 跨学期的指纹库，每个被查重的文件对应一个只追加的sqlite数据库。
+    # 查询时跳过出现在过多文件中的指纹，出现次数同时受比例与绝对数量限制，
+    # 使每份提交的查询代价不随指纹库的增长而增加。
+    def __init__(self, db_path, k, window, max_doc_freq=0.5, max_postings=100):
+        self.db = sqlite3.connect(db_path)
+        self.max_doc_freq = max_doc_freq
+        self.max_postings = max_postings
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS docs (
+                id INTEGER PRIMARY KEY, name TEXT, tag TEXT, digest TEXT, fingerprint_count INTEGER,
+                UNIQUE (digest, name)
+            );
+            CREATE TABLE IF NOT EXISTS postings (hash INTEGER, doc INTEGER);
+            CREATE INDEX IF NOT EXISTS postings_hash ON postings (hash);
+            CREATE TABLE IF NOT EXISTS hash_freq (hash INTEGER PRIMARY KEY, count INTEGER);
+        """)
+        # 指纹参数不同时，新旧指纹无法比较。
+        params = json.dumps({"k": k, "window": window})
+        stored = self.db.execute("SELECT value FROM meta WHERE key = 'params'").fetchone()
+        if stored is None:
+            self.db.execute("INSERT INTO meta VALUES ('params', ?)", (params,))
+            self.db.commit()
+        elif stored[0] != params:
+            raise ValueError(f"指纹库{db_path}的参数{stored[0]}与当前参数{params}不一致")
+
+    @staticmethod
+    def signed(h):
+        # sqlite的整数为有符号64位。
+        return h - (1 << 64) if h >= (1 << 63) else h
+
+    def doc_count(self):
+        return self.db.execute("SELECT COUNT(*) FROM docs").fetchone()[0]
+
+    def contains(self, name, digest):
+        return self.db.execute("SELECT 1 FROM docs WHERE digest = ? AND name = ?", (digest, name)).fetchone() is not None
+
+    def add(self, name, tag, digest, fingerprints):
+        if self.contains(name, digest):
+            return False
+        cursor = self.db.execute(
+            "INSERT INTO docs (name, tag, digest, fingerprint_count) VALUES (?, ?, ?, ?)",
+            (name, tag, digest, len(fingerprints))
+        )
+        hashes = [(self.signed(h),) for h in fingerprints]
+        self.db.executemany(f"INSERT INTO postings VALUES (?, {cursor.lastrowid})", hashes)
+        self.db.executemany("INSERT INTO hash_freq VALUES (?, 1) ON CONFLICT (hash) DO UPDATE SET count = count + 1", hashes)
+        self.db.commit()
+        return True
+
+    def query(self, fingerprints, exclude_tag=None, exclude_name=None, exclude_digest=None):
+        # 返回[(名称, 标签, 共享指纹数, 该文件指纹数)]。exclude_tag用于排除本批次的文件，exclude_name与exclude_digest用于排除文件自身。
+        max_postings = posting_limit(self.max_doc_freq, self.doc_count(), self.max_postings)
+        self.db.execute("CREATE TEMP TABLE IF NOT EXISTS query (hash INTEGER PRIMARY KEY)")
+        self.db.execute("DELETE FROM query")
+        self.db.executemany("INSERT OR IGNORE INTO query VALUES (?)", [(self.signed(h),) for h in fingerprints])
+        rows = self.db.execute("""
+            SELECT docs.name, docs.tag, COUNT(*), docs.fingerprint_count
+            FROM query
+            JOIN hash_freq ON hash_freq.hash = query.hash AND hash_freq.count <= ?
+            JOIN postings ON postings.hash = query.hash
+            JOIN docs ON docs.id = postings.doc
+            WHERE docs.tag IS NOT ? AND NOT (docs.name IS ? AND docs.digest IS ?)
+            GROUP BY docs.id
+        """, (max_postings, exclude_tag, exclude_name, exclude_digest)).fetchall()
+        return rows
+
+    def close(self):
+        self.db.close()